@@ -0,0 +1,96 @@
+import json
+import logging
+import shlex
+import sqlite3
+
+from resorter.actions.actions import ACTIONS, Action
+from resorter.modules.modules import Module
+from resorter.modules.content import Content
+
+HEAD = 65536 # bytes of the head and of the tail compared before the whole files
+
+class Dupes(Action):
+    """Prints the groups of files with the same content and the same expression values, as the
+    files are found: a file of the same size as earlier ones is compared to them by its head and
+    tail, then by its whole content if they match. When a file is found identical to an earlier one,
+    they are printed as a group, and a later copy is printed as a group with the first one.
+    The files are kept in a temporary database, not in memory."""
+
+    def __init__(self, expressions, dry=False):
+        self.dry = dry
+        self.db = sqlite3.connect('') # temporary, on disk
+        self.db.execute('CREATE TABLE files (key TEXT, size INTEGER, path TEXT, head TEXT, digest TEXT, first INTEGER)')
+        self.db.execute('CREATE INDEX candidates ON files (key, size)')
+        self.groups = 0
+        self.copies = 0
+
+    @staticmethod
+    def head(path):
+        return Content.headhash(None, [path, HEAD])
+
+    @staticmethod
+    def digest(path, size, head):
+        return head if size <= 2 * HEAD else Content.hash(None, [path]) # the whole files were compared
+
+    def fill(self, rowid, column, compute, path):
+        """Computes a missing digest of an earlier file, None if it can't be read anymore."""
+        try:
+            value = compute(path)
+        except OSError as e:
+            logging.warning(f'could not read {path}: {e}')
+            self.db.execute('DELETE FROM files WHERE rowid = ?', (rowid,))
+            return None
+        self.db.execute(f'UPDATE files SET {column} = ? WHERE rowid = ?', (value, rowid))
+        return value
+
+    def act(self, source, dst):
+        size = Module.CACHE.stat(source).st_size
+        if size == 0:
+            return
+        key, path = json.dumps(dst, default=str), str(source)
+        earlier = self.db.execute('SELECT rowid, path, head, digest, first FROM files WHERE key = ? AND size = ? '
+                                  'ORDER BY rowid', (key, size)).fetchall()
+        rowid = self.db.execute('INSERT INTO files (key, size, path) VALUES (?, ?, ?)', (key, size, path)).lastrowid
+        if not earlier:
+            return # not read unless another file has the same size
+        try:
+            head = self.head(path)
+        except OSError as e:
+            logging.warning(f'could not read {path}: {e}')
+            self.db.execute('DELETE FROM files WHERE rowid = ?', (rowid,))
+            return
+        self.db.execute('UPDATE files SET head = ? WHERE rowid = ?', (head, rowid))
+        same = []
+        for r, p, h, d, first in earlier:
+            if h is None:
+                h = self.fill(r, 'head', self.head, p)
+            if h == head:
+                same.append((r, p, h, d, first))
+        if not same:
+            return
+        try:
+            digest = self.digest(path, size, head)
+        except OSError as e:
+            logging.warning(f'could not read {path}: {e}')
+            self.db.execute('DELETE FROM files WHERE rowid = ?', (rowid,))
+            return
+        self.db.execute('UPDATE files SET digest = ? WHERE rowid = ?', (digest, rowid))
+        for r, p, h, d, first in same: # the first file of a group comes before the others
+            if d is None:
+                d = self.fill(r, 'digest', lambda f: self.digest(f, size, h), p)
+            if d == digest:
+                if first is None: # a new group
+                    self.groups += 1
+                    self.db.execute('UPDATE files SET first = ? WHERE rowid = ?', (r, r))
+                self.db.execute('UPDATE files SET first = ? WHERE rowid = ?', (r, rowid))
+                self.copies += 1
+                print('\n'.join(shlex.quote(f) for f in (p, path)), end='\n\n', flush=True)
+                return
+
+    def finalize(self):
+        logging.info(f'{self.groups} groups of duplicates, {self.copies} copies')
+        self.db.close()
+
+ACTIONS.update({'dupes': {'class': Dupes, 'expressions': ['""'],
+    'help': 'print groups of non-empty files with identical content and the same values of the expressions, if given, '
+            'as soon as found: a later copy is printed with the first file of its group'}})
@@ -0,0 +1,97 @@
+import logging
+import shlex
+
+from resorter.actions.actions import ACTIONS, Action
+
+DISTANCE = 10 # bits
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree(object):
+    """Burkhard-Keller tree of integers under the Hamming distance: the children of a node are
+    keyed by their distance to it, so a search within a radius visits few branches."""
+
+    def __init__(self):
+        self.root = None # [value, items, {distance: child}]
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = distance(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d, None)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """Yields (distance, value, items) of the nodes within radius of value."""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = distance(value, node[0])
+            if d <= radius:
+                yield d, node[0], node[1]
+            for k, child in node[2].items():
+                if d - radius <= k <= d + radius:
+                    stack.append(child)
+
+class Similar(Action):
+    """Prints the groups of files whose hashes, computed by the first expression, differ by at most
+    the number of bits the second expression computes (10 by default): the connected components
+    of the files within that distance of each other."""
+
+    def __init__(self, expressions, dry=False):
+        self.dry = dry
+        self.tree = BKTree()
+        self.parent = {} # union-find over the file paths
+
+    def find(self, path):
+        root = path
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[path] != root:
+            self.parent[path], path = root, self.parent[path]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[b] = a
+
+    def act(self, source, dst):
+        if dst[0] is None:
+            return
+        value = int(dst[0], 16) if isinstance(dst[0], str) else int(dst[0])
+        radius = int(dst[1]) if len(dst) > 1 and dst[1] is not None else DISTANCE
+        source = str(source)
+        self.parent[source] = source
+        for _, _, items in self.tree.search(value, radius):
+            self.union(items[0], source)
+        self.tree.add(value, source)
+
+    def finalize(self):
+        groups = {}
+        for path in self.parent:
+            groups.setdefault(self.find(path), []).append(path)
+        n = 0
+        for group in groups.values():
+            if len(group) > 1:
+                n += 1
+                print('\n'.join(shlex.quote(p) for p in group), end='\n\n')
+        logging.info(f'{n} groups of similar files out of {self.tree.size}')
+
+ACTIONS.update({'similar': {'class': Similar, 'expressions': ['image_dhash'],
+    'help': 'print groups of similar images: the first expression computes a hash (image_dhash by default, or image_phash), '
+            'the second the maximum number of differing bits (10 by default)'}})
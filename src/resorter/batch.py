@@ -0,0 +1,138 @@
+try:
+    import numpy
+    OK = True
+except:
+    OK = False
+
+import itertools
+import logging
+import operator
+
+from resorter.utils import Const, Call, Neg, Logic, BinOp, Match, Precompiled, BINARY, literals, number
+
+# operators applied to whole NumPy columns at once, looped over the rows otherwise
+VECTOR = {
+        '<': operator.lt,
+        '>': operator.gt,
+        '=': operator.eq,
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<>': operator.ne,
+        '>=': operator.ge,
+        '<=': operator.le,
+        '+': operator.add,
+        '-': operator.sub,
+        }
+
+def numbers(values, typecode):
+    """Numeric column: a NumPy array when available, the list of values otherwise."""
+    if OK:
+        return numpy.array(values, dtype=numpy.int64 if typecode == 'q' else numpy.float64)
+    return values
+
+def numeric(v):
+    if OK and isinstance(v, numpy.ndarray):
+        return v.dtype.kind in 'if'
+    return type(v) in (int, float)
+
+def rows(v, n):
+    """Column as a list of python values, a scalar repeated n times."""
+    if isinstance(v, list):
+        return v
+    if OK and isinstance(v, numpy.ndarray):
+        return v.tolist()
+    return [v] * n
+
+def vectorizable(node):
+    """True if some part of the node can be computed column-wise."""
+    if isinstance(node, Call):
+        return 'column' in node.f and node.subject is None and (node.args is None or literals(node.args) is not None)
+    if isinstance(node, (Match, Precompiled)):
+        return True
+    if isinstance(node, (Neg, Logic, BinOp)):
+        return any(vectorizable(c) for c in node.children())
+    return False
+
+class Batch(object):
+    """Computes the roots of an expression for a chunk of Contexts at once, storing them in the Context memos.
+    The roots must be compiled memoized (see utils.share) for the rows to pick the values up."""
+
+    def __init__(self, expression, shared=()):
+        self.expression = expression
+        self.shared = shared
+        self.closures = {}
+        self.roots = [r for r in expression.tree or [] if r.pure() and vectorizable(r)]
+        logging.debug(f'batch roots of {expression.expr!r}: {self.roots}')
+
+    def row(self, node, contexts):
+        f = self.closures.get(id(node), None)
+        if f is None:
+            f = self.closures[id(node)] = node.compile(self.shared)
+        return [f(ctx) for ctx in contexts]
+
+    def operand(self, node, contexts):
+        return node.value if isinstance(node, Const) else self.column(node, contexts)
+
+    def column(self, node, contexts):
+        n = len(contexts)
+        if isinstance(node, Call) and vectorizable(node):
+            values = literals(node.args) if node.args is not None else []
+            return node.f['column'](node.name, [ctx.source for ctx in contexts], values)
+        if isinstance(node, BinOp):
+            a, b = self.operand(node.a, contexts), self.operand(node.b, contexts)
+            if node.op in VECTOR and numeric(a) and numeric(b):
+                return VECTOR[node.op](a, b)
+            op = BINARY[node.op]
+            return [op(x, y) for x, y in zip(rows(a, n), rows(b, n))]
+        if isinstance(node, Logic):
+            # the right operand is computed only for the rows it decides
+            a = list(rows(self.operand(node.a, contexts), n))
+            if node.op == '&&':
+                need = [i for i, v in enumerate(a) if v]
+            else:
+                need = [i for i, v in enumerate(a) if not v]
+            if need:
+                b = rows(self.operand(node.b, [contexts[i] for i in need]), len(need))
+                for i, v in zip(need, b):
+                    a[i] = v
+            return a
+        if isinstance(node, Neg):
+            a = self.column(node.a, contexts)
+            if numeric(a):
+                return -a
+            return [-number(v) for v in rows(a, n)]
+        if isinstance(node, Match):
+            fullmatch = node.pattern.fullmatch
+            return [True if fullmatch(str(v)) else False for v in rows(self.column(node.a, contexts), n)]
+        if isinstance(node, Precompiled):
+            matcher = node.matcher
+            if node.subject is None:
+                values = [ctx.source for ctx in contexts]
+            else:
+                values = rows(self.column(node.subject, contexts), n)
+            return [None if v is None else matcher(v) for v in values]
+        return self.row(node, contexts)
+
+    def fill(self, contexts):
+        for root in self.roots:
+            try:
+                values = rows(self.column(root, contexts), len(contexts))
+            except Exception as e:
+                logging.debug(f'batch of {root!r} failed, computing rows one by one: {e!r}')
+                continue
+            key = root.key
+            for ctx, v in zip(contexts, values):
+                ctx.memo[key] = v
+
+def batches(contexts, expressions, size, shared=()):
+    """Yields the contexts, having computed the expressions over chunks of `size` of them."""
+    plans = [Batch(e, shared) for e in expressions]
+    plans = [p for p in plans if p.roots]
+    contexts = iter(contexts)
+    while True:
+        chunk = list(itertools.islice(contexts, size))
+        if not chunk:
+            return
+        for p in plans:
+            p.fill(chunk)
+        yield from chunk
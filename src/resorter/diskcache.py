@@ -0,0 +1,83 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from resorter.utils import MISSING
+
+def default_path():
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'resorter', 'metadata.db')
+
+class DiskCache(object):
+    """Metadata extracted from the files, kept across runs in an SQLite database shared by the processes.
+    Entries are keyed by module, device and inode, and valid while the size and the modification
+    time of the file are the same. Beyond `limit` bytes of data, the oldest entries are dropped."""
+
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS metadata (module TEXT, dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, ' \
+             'data BLOB, added REAL, PRIMARY KEY (module, dev, ino))'
+
+    def __init__(self, path=None, limit=256 * 1024 * 1024, check_every=1000):
+        self.path = path or default_path()
+        self.limit = limit
+        self.check_every = check_every
+        self.local = threading.local() # sqlite connections can't be shared by threads
+        self.lock = threading.Lock()
+        self.writes = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.prune()
+
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute(DiskCache.SCHEMA)
+        return db
+
+    def get(self, module, st):
+        row = self.db().execute('SELECT size, mtime, data FROM metadata WHERE module = ? AND dev = ? AND ino = ?',
+                                (module, st.st_dev, st.st_ino)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return MISSING
+        try:
+            return pickle.loads(row[2])
+        except Exception as e:
+            logging.debug(f'dropping unreadable {module} metadata: {e!r}')
+            return MISSING
+
+    def put(self, module, st, data):
+        try:
+            blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logging.debug(f'could not store {module} metadata: {e!r}')
+            return
+        db = self.db()
+        with db:
+            db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (module, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, blob, time.time()))
+        with self.lock:
+            self.writes += 1
+            check = self.writes % self.check_every == 0
+        if check:
+            self.prune()
+
+    def prune(self):
+        """Drops the oldest entries beyond the size limit."""
+        db = self.db()
+        size = db.execute('SELECT total(length(data)) FROM metadata').fetchone()[0]
+        if size <= self.limit:
+            return
+        logging.info(f'metadata cache {self.path} holds {size:.0f} bytes, pruning to {self.limit}')
+        with db:
+            rows = db.execute('SELECT rowid, length(data) FROM metadata ORDER BY added').fetchall()
+            drop = []
+            for rowid, length in rows:
+                if size <= self.limit * 0.9: # some room for the next entries
+                    break
+                drop.append((rowid,))
+                size -= length
+            db.executemany('DELETE FROM metadata WHERE rowid = ?', drop)
@@ -0,0 +1,109 @@
+"""Header-only image metadata reader: pixel size and EXIF tags of JPEG, TIFF and PNG files,
+in the form ImageData works with. Rationals are (numerator, denominator) tuples."""
+
+import mmap
+import struct
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+WIDTH, HEIGHT = 0x100, 0x101
+
+# TIFF field type: (item size, struct format)
+TYPES = {
+    1: (1, 'B'), # BYTE
+    2: (1, None), # ASCII
+    3: (2, 'H'), # SHORT
+    4: (4, 'I'), # LONG
+    5: (8, 'II'), # RATIONAL
+    6: (1, 'b'), # SBYTE
+    7: (1, None), # UNDEFINED
+    8: (2, 'h'), # SSHORT
+    9: (4, 'i'), # SLONG
+    10: (8, 'ii'), # SRATIONAL
+}
+
+# JPEG start of frame markers, holding the image size
+SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+def value(data, endian, typ, count, offset):
+    size, fmt = TYPES[typ]
+    raw = data[offset:offset + size * count]
+    if fmt is None:
+        return raw.rstrip(b'\0').decode('ascii', 'replace').strip() if typ == 2 else bytes(raw)
+    items = struct.unpack(endian + fmt * count, raw)
+    if len(fmt) == 2:
+        items = tuple(zip(items[::2], items[1::2]))
+    return items[0] if count == 1 else items
+
+def ifd(data, offset, endian, wanted):
+    """Values of the wanted tags in the IFD at offset, the nested EXIF and GPS IFDs merged in
+    like PIL's legacy getexif did: EXIF tags directly, GPS tags as a dict under GPS_IFD."""
+    tags = {}
+    n, = struct.unpack_from(endian + 'H', data, offset)
+    for i in range(n):
+        entry = offset + 2 + 12 * i
+        tag, typ, count = struct.unpack_from(endian + 'HHI', data, entry)
+        if tag not in wanted and tag not in (EXIF_IFD, GPS_IFD) or typ not in TYPES:
+            continue
+        at = entry + 8
+        if TYPES[typ][0] * count > 4:
+            at, = struct.unpack_from(endian + 'I', data, at)
+        v = value(data, endian, typ, count, at)
+        if tag == EXIF_IFD:
+            tags.update(ifd(data, v, endian, wanted))
+        elif tag == GPS_IFD:
+            tags[GPS_IFD] = ifd(data, v, endian, range(0x20))
+        else:
+            tags[tag] = v
+    return tags
+
+def tiff(data, wanted):
+    """Tags of the first IFD of a TIFF structure."""
+    endian = {b'II': '<', b'MM': '>'}.get(bytes(data[:2]), None)
+    if endian is None or struct.unpack_from(endian + 'H', data, 2)[0] != 42:
+        return None
+    offset, = struct.unpack_from(endian + 'I', data, 4)
+    return ifd(data, offset, endian, wanted)
+
+def jpeg(f, wanted):
+    size, tags = None, {}
+    f.seek(2)
+    while size is None:
+        b = f.read(1)
+        while b == b'\xff': # fill bytes
+            b = f.read(1)
+        if not b:
+            break
+        marker = b[0]
+        if marker in (0xD9, 0xDA): # end of image, start of scan
+            break
+        length, = struct.unpack('>H', f.read(2))
+        if marker == 0xE1 and not tags:
+            segment = f.read(length - 2)
+            if segment.startswith(b'Exif\0\0'):
+                tags = tiff(segment[6:], wanted) or {}
+        elif marker in SOF:
+            _, height, width = struct.unpack('>BHH', f.read(5))
+            size = (width, height)
+        else:
+            f.seek(length - 2, 1)
+    return {'size': size, 'exif': tags}
+
+def read(path, wanted):
+    """{'size': (width, height), 'exif': {tag: value}} of the image, None if the format isn't supported."""
+    with open(path, 'rb') as f:
+        head = f.read(16)
+        if head[:2] == b'\xff\xd8':
+            data = jpeg(f, wanted)
+            return data if data['size'] is not None else None
+        if head[:8] == PNG:
+            width, height = struct.unpack('>II', f.read(8))
+            return {'size': (width, height), 'exif': {}}
+        if head[:4] in (b'II*\0', b'MM\0*'):
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                tags = tiff(data, set(wanted) | {WIDTH, HEIGHT})
+            size = (tags.pop(WIDTH, None), tags.pop(HEIGHT, None))
+            return {'size': size, 'exif': tags}
+    return None
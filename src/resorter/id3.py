@@ -0,0 +1,135 @@
+"""Header-only ID3 reader: the text frames behind the id3_* functions, from an ID3v2 tag,
+or from the ID3v1 tag at the end of the file. Values follow stagger: text, track and disc numbers."""
+
+import os
+
+class Unsupported(Exception):
+    """A tag this reader doesn't decode: compressed or encrypted frames, unknown versions."""
+
+# ID3v2.3/2.4 and ID3v2.2 frame ids of the tags
+FRAMES = {
+    b'TIT2': 'title', b'TPE1': 'artist', b'TALB': 'album', b'TCOM': 'composer',
+    b'TCON': 'genre', b'TRCK': 'track', b'TPOS': 'disc',
+    b'TT2': 'title', b'TP1': 'artist', b'TAL': 'album', b'TCM': 'composer',
+    b'TCO': 'genre', b'TRK': 'track', b'TPA': 'disc',
+}
+
+TAGS = ['composer', 'title', 'album', 'artist', 'genre', 'disc', 'track']
+NUMBERS = ('track', 'disc')
+
+GENRES = [
+    'Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk', 'Grunge', 'Hip-Hop', 'Jazz', 'Metal',
+    'New Age', 'Oldies', 'Other', 'Pop', 'R&B', 'Rap', 'Reggae', 'Rock', 'Techno', 'Industrial',
+    'Alternative', 'Ska', 'Death Metal', 'Pranks', 'Soundtrack', 'Euro-Techno', 'Ambient', 'Trip-Hop', 'Vocal', 'Jazz+Funk',
+    'Fusion', 'Trance', 'Classical', 'Instrumental', 'Acid', 'House', 'Game', 'Sound Clip', 'Gospel', 'Noise',
+    'AlternRock', 'Bass', 'Soul', 'Punk', 'Space', 'Meditative', 'Instrumental Pop', 'Instrumental Rock', 'Ethnic', 'Gothic',
+    'Darkwave', 'Techno-Industrial', 'Electronic', 'Pop-Folk', 'Eurodance', 'Dream', 'Southern Rock', 'Comedy', 'Cult', 'Gangsta',
+    'Top 40', 'Christian Rap', 'Pop/Funk', 'Jungle', 'Native American', 'Cabaret', 'New Wave', 'Psychadelic', 'Rave', 'Showtunes',
+    'Trailer', 'Lo-Fi', 'Tribal', 'Acid Punk', 'Acid Jazz', 'Polka', 'Retro', 'Musical', 'Rock & Roll', 'Hard Rock',
+]
+
+ENCODINGS = ['latin-1', 'utf-16', 'utf-16-be', 'utf-8']
+
+def syncsafe(b):
+    return b[0] << 21 | b[1] << 14 | b[2] << 7 | b[3]
+
+def text(data):
+    """First value of a text frame."""
+    if not data or data[0] >= len(ENCODINGS):
+        return ''
+    encoding = ENCODINGS[data[0]]
+    s = data[1:].decode(encoding, 'replace')
+    return s.split('\0', 1)[0].strip()
+
+def genre(s):
+    """Genre names for the (n) and n references to ID3v1 genres."""
+    ref = s[1:s.index(')')] if s.startswith('(') and ')' in s else s
+    if ref.isdigit() and int(ref) < len(GENRES):
+        rest = s[len(ref) + 2:] if s.startswith('(') else ''
+        return rest or GENRES[int(ref)]
+    return s
+
+def number(s):
+    s = s.split('/', 1)[0].strip()
+    return int(s) if s.isdigit() else 0
+
+def frames(f, version, size):
+    """Yields (frame id, body) of the text frames of the tag, skipping the other frames."""
+    header = 6 if version == 2 else 10
+    end = f.tell() + size
+    while f.tell() + header <= end:
+        h = f.read(header)
+        if len(h) < header or h[0] == 0: # padding
+            return
+        if version == 2:
+            fid, length, flags = h[:3], int.from_bytes(h[3:6], 'big'), 0
+        else:
+            fid, length, flags = h[:4], h[4:8], int.from_bytes(h[8:10], 'big')
+            length = syncsafe(length) if version == 4 else int.from_bytes(length, 'big')
+        if fid not in FRAMES:
+            f.seek(length, 1)
+            continue
+        if flags & (0x00C0 if version == 3 else 0x000C): # compressed or encrypted
+            raise Unsupported(f'{fid} flags {flags:#x}')
+        body = f.read(length)
+        if flags & (0x0020 if version == 3 else 0x0040): # grouping identity byte
+            body = body[1:]
+        if version == 4 and flags & 0x0002: # unsynchronised
+            body = body.replace(b'\xff\x00', b'\xff')
+        if version == 4 and flags & 0x0001: # data length indicator
+            body = body[4:]
+        yield fid, body
+
+def v2(f):
+    """Tags of the ID3v2 tag at the start of the file, None if there is none."""
+    h = f.read(10)
+    if len(h) < 10 or h[:3] != b'ID3':
+        return None
+    version, flags, size = h[3], h[5], syncsafe(h[6:10])
+    if version not in (2, 3, 4):
+        raise Unsupported(f'ID3v2.{version}')
+    if flags & 0x80 and version < 4: # whole tag unsynchronised
+        raise Unsupported('unsynchronised tag')
+    if flags & 0x40 and version > 2: # extended header
+        ext = f.read(4)
+        f.seek((syncsafe(ext) if version == 4 else int.from_bytes(ext, 'big') + 4) - 4, 1)
+        size -= f.tell() - 10
+    tags = {}
+    for fid, body in frames(f, version, size):
+        tags.setdefault(FRAMES[fid], text(body))
+    return tags
+
+def v1(f):
+    """Tags of the ID3v1 tag at the end of the file, None if there is none."""
+    f.seek(0, os.SEEK_END)
+    if f.tell() < 128:
+        return None
+    f.seek(-128, os.SEEK_END)
+    data = f.read(128)
+    if data[:3] != b'TAG':
+        return None
+    field = lambda a, b: data[a:b].split(b'\0', 1)[0].decode('latin-1').strip()
+    tags = {'title': field(3, 33), 'artist': field(33, 63), 'album': field(63, 93)}
+    if data[125] == 0 and data[126]: # ID3v1.1 track number
+        tags['track'] = str(data[126])
+    if data[127] < len(GENRES):
+        tags['genre'] = GENRES[data[127]]
+    return tags
+
+def read(path):
+    """{tag: value} for all of the id3 tags, None if the file has no ID3 tag."""
+    with open(path, 'rb') as f:
+        tags = v2(f)
+        if tags is None:
+            tags = v1(f)
+    if tags is None:
+        return None
+    result = {}
+    for name in TAGS:
+        value = tags.get(name, '')
+        if name in NUMBERS:
+            value = number(value)
+        elif name == 'genre':
+            value = genre(value)
+        result[name] = value
+    return result
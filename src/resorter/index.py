@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from resorter.utils import PathEntry, MISSING
+
+class Index(object):
+    """SQLite index of the files processed by previous runs and of the values computed for them.
+    A file is unchanged if its inode, size and modification time are the indexed ones,
+    and its values are reused if they were computed by the same expressions, unless some are impure:
+    a counter or a custom command may compute something else on the next run.
+    Files may be looked up and stored from several threads: the lookups read through a connection
+    per thread, the stores write through one shared connection, one at a time."""
+
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime INTEGER, ' \
+             'expressions TEXT, vals TEXT)'
+
+    def __init__(self, path, expressions, commit_every=1000):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False) # guarded by the lock
+        self.db.execute(Index.SCHEMA)
+        self.db.commit()
+        self.local = threading.local() # connections to read from each thread
+        self.lock = threading.Lock()
+        self.expressions = hashlib.sha1('\0'.join(e.expr for e in expressions).encode()).hexdigest()
+        self.replay = all(e.pure() for e in expressions)
+        if not self.replay:
+            logging.info('impure expressions: the indexed values are not reused')
+        self.commit_every = commit_every
+        self.writes = 0
+        self.states = {} # looked up sources, to store them with the state they were computed for
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def state(source):
+        st = source.stat() if isinstance(source, PathEntry) else os.stat(source)
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path)
+        return db
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def lookup(self, source):
+        """The values indexed for the source, MISSING if it is new or changed, or if they can't be reused."""
+        values = self.indexed(source)
+        return values if self.replay else MISSING
+
+    def indexed(self, source):
+        """The values indexed for the source, MISSING if it is new or changed."""
+        try:
+            state = self.states[source] = self.state(source)
+        except OSError as e:
+            logging.debug(f'index lookup of {source} failed: {e!r}')
+            self.count(False)
+            return MISSING
+        row = self.connection().execute('SELECT inode, size, mtime, expressions, vals FROM files WHERE path = ?',
+                              (os.path.abspath(source),)).fetchone()
+        if row is None or row[:3] != state or row[3] != self.expressions:
+            self.count(False)
+            return MISSING
+        self.count(True)
+        return json.loads(row[4])
+
+    def changed(self, contexts):
+        """Yields the contexts of the sources new or changed since indexed."""
+        for ctx in contexts:
+            if self.indexed(ctx.source) is MISSING:
+                yield ctx
+            else:
+                self.discard(ctx.source) # not stored again
+                logging.debug(f'unchanged {ctx.source}')
+
+    def discard(self, source):
+        """Forgets the state looked up for a source which won't be stored."""
+        self.states.pop(source, None)
+
+    def store(self, source, values):
+        state = self.states.pop(source, None)
+        try:
+            if state is None:
+                state = self.state(source)
+            values = json.dumps(values)
+        except (OSError, TypeError) as e:
+            logging.debug(f'could not index {source}: {e!r}')
+            return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                            (os.path.abspath(source), *state, self.expressions, values))
+            self.writes += 1
+            if self.writes % self.commit_every == 0:
+                self.db.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        logging.info(f'index: {self.hits} unchanged, {self.misses} new or changed files')
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -4,9 +4,15 @@ try:
 except:
     OK = False
 
+import logging
+import resorter.id3
+from resorter.id3 import TAGS
 from resorter.modules.modules import MODULES, Module
+from resorter.utils import COST_READ
 
 class Id3(Module):
+    cost = COST_READ
+    persistent = True
 
     @classmethod
     def functions(cls):
@@ -22,16 +28,23 @@ class Id3(Module):
     
     @classmethod
     def open(cls, source):
+        """text tags, read from the tag frames or with stagger"""
         try:
-            return stagger.read_tag(source)
+            return resorter.id3.read(source)
+        except Exception as e:
+            logging.debug(f'reading {source} tag failed: {e!r}')
+        if not OK:
+            return None
+        try:
+            tag = stagger.read_tag(source)
         except stagger.errors.NoTagError:
             return None
+        return {t: getattr(tag, t) for t in TAGS}
     
     @staticmethod
     def tag(key, args):
         id3 = Id3.cache(args[0])
         if id3 is None: return None
-        return id3.__getattribute__(key.lstrip('id3_'))
+        return id3[key[4:]]
 
-if OK:
-    MODULES.append(Id3)
+MODULES.append(Id3)
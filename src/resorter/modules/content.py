@@ -0,0 +1,67 @@
+import hashlib
+import mmap
+import os
+from resorter.modules.modules import MODULES, Module
+from resorter.utils import COST_READ
+
+BLOCK = 1024 * 1024
+
+class Content(Module):
+    cost = COST_READ
+    persistent = True
+
+    @classmethod
+    def functions(cls):
+        return {
+                'hash': {'func': cls.hash, 'help': r'hex digest of the file content', 'args': ['algorithm: sha256 (default), blake2b, md5...'],
+                         'example': "hash['md5'].sub[0,8]"},
+                'headhash': {'func': cls.headhash, 'help': r'hex digest of the file size and of its first and last bytes',
+                             'args': ['number of bytes, 65536 by default'], 'example': "headhash[4096]"},
+        }
+
+    @staticmethod
+    def digest(f, algorithm):
+        """Hashes the whole file, mapped in memory or by blocks. hashlib releases the GIL meanwhile."""
+        h = hashlib.new(algorithm)
+        with open(f, 'rb') as source:
+            try:
+                with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    h.update(data)
+                    return h.hexdigest()
+            except (ValueError, OSError): # empty or not mappable
+                pass
+            buffer = bytearray(BLOCK)
+            view = memoryview(buffer)
+            while True:
+                n = source.readinto(buffer)
+                if not n:
+                    break
+                h.update(view[:n])
+        return h.hexdigest()
+
+    @staticmethod
+    def head_digest(f, n):
+        h = hashlib.blake2b(digest_size=16)
+        with open(f, 'rb') as source:
+            size = os.fstat(source.fileno()).st_size
+            h.update(size.to_bytes(8, 'little'))
+            if size <= 2 * n:
+                h.update(source.read())
+            else:
+                h.update(source.read(n))
+                source.seek(-n, os.SEEK_END)
+                h.update(source.read(n))
+        return h.hexdigest()
+
+    @staticmethod
+    def hash(_, args):
+        algorithm = args[1] if len(args) > 1 else 'sha256'
+        hashlib.new(algorithm) # unknown algorithms fail before opening the file
+        return Module.CACHE.get(f'Content.{algorithm}', args[0], lambda f: Content.digest(f, algorithm), True)
+
+    @staticmethod
+    def headhash(_, args):
+        n = int(args[1]) if len(args) > 1 else 65536
+        return Module.CACHE.get(f'Content.head{n}', args[0], lambda f: Content.head_digest(f, n), True)
+
+MODULES.append(Content)
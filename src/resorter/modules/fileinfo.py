@@ -3,27 +3,41 @@ from datetime import datetime
 import logging
 import pathlib
 from resorter.modules.modules import MODULES, Module
+from resorter.utils import COST_STAT, PathEntry
+from resorter.batch import numbers
 
 class FileInfo(Module):
 
     @classmethod
     def functions(cls):
         return {
-                'name': {'func': cls.name, 'set': cls.setname, 'help': 'file name with extension, without path', 'example': 'name'},
+                'name': {'func': cls.name, 'set': cls.setname, 'safe': True, 'help': 'file name with extension, without path', 'example': 'name'},
                 'path': {'func': cls.path, 'help': 'file path without file name', 'args': ['last parent index'], 'example': 'path[2]', 'source': 'a/b/c/name.ext'},
                 'parent': {'func': cls.path, 'help': 'file path without file name', 'args': ['parent index'], 'example': 'parent[1]'},
                 'abspath': {'func': cls.abspath, 'help': 'absolute file path without file name', 'example': 'abspath'},
-                'ext': {'func': cls.ext, 'set': cls.setext, 'help': 'file extension with leading dot', 'example': 'ext'},
-                'nam': {'func': cls.nam, 'set': cls.setnam, 'help': 'file name without extension', 'example': 'nam'},
-                'size': {'func': cls.size, 'help': r'file size in bytes', 'args': ['metric prefix k/m/g/t/p'], 'example': 'size[m]', 'output': 42},
-                'atime': {'func': cls.atime, 'help': r'file last access time', 'args': ['python time format string'], 'example': "atime['%Y']", 'output': '2019'},
-                'ctime': {'func': cls.ctime, 'help': r'file creation time', 'args': ['python time format string'], 'example': "ctime['%Y']", 'output': '2019'},
-                'mtime': {'func': cls.mtime, 'help': r'file last modification time', 'args': ['python time format string'], 'example': "mtime['%Y']", 'output': '2019'},
+                'ext': {'func': cls.ext, 'set': cls.setext, 'safe': True, 'help': 'file extension with leading dot', 'example': 'ext'},
+                'nam': {'func': cls.nam, 'set': cls.setnam, 'safe': True, 'help': 'file name without extension', 'example': 'nam'},
+                'size': {'func': cls.size, 'column': cls.columns, 'cost': COST_STAT, 'help': r'file size in bytes', 'args': ['metric prefix k/m/g/t/p'], 'example': 'size[m]', 'output': 42},
+                'atime': {'func': cls.atime, 'column': cls.columns, 'cost': COST_STAT, 'help': r'file last access time', 'args': ['python time format string'], 'example': "atime['%Y']", 'output': '2019'},
+                'ctime': {'func': cls.ctime, 'column': cls.columns, 'cost': COST_STAT, 'help': r'file creation time', 'args': ['python time format string'], 'example': "ctime['%Y']", 'output': '2019'},
+                'mtime': {'func': cls.mtime, 'column': cls.columns, 'cost': COST_STAT, 'help': r'file last modification time', 'args': ['python time format string'], 'example': "mtime['%Y']", 'output': '2019'},
         }
 
     @classmethod
     def open(cls, f):
-        return os.stat(f)
+        return f.stat() if isinstance(f, PathEntry) else os.stat(f)
+
+    @classmethod
+    def cache(cls, f):
+        return Module.CACHE.stat(f)
+
+    @staticmethod
+    def rename(source, newname):
+        logging.debug(f'rename {source} to {newname}')
+        os.rename(source, newname)
+        Module.CACHE.invalidate(source)
+        Module.CACHE.invalidate(newname)
+        return newname
 
     @staticmethod
     def name(_, args):
@@ -32,9 +46,7 @@ class FileInfo(Module):
     @staticmethod
     def setname(_, args):
         newname = os.path.join(os.path.dirname(args[0]), args[1])
-        logging.debug(f'rename {args[0]} to {newname}')
-        os.rename(args[0], newname)
-        return newname
+        return FileInfo.rename(args[0], newname)
 
     @staticmethod
     def abspath(_, args):
@@ -64,9 +76,7 @@ class FileInfo(Module):
     def setext(_, args):
         root, _ = os.path.splitext(args[0])
         newname = root + args[1]
-        logging.debug(f'rename {args[0]} to {newname}')
-        os.rename(args[0], newname)
-        return newname
+        return FileInfo.rename(args[0], newname)
 
     @staticmethod
     def nam(_, args):
@@ -77,22 +87,24 @@ class FileInfo(Module):
         path, name = os.path.split(args[0])
         _, ext = os.path.splitext(name)
         newname = os.path.join(path, args[1] + ext)
-        logging.debug(f'rename {args[0]} to {newname}')
-        os.rename(args[0], newname)
-        return newname
+        return FileInfo.rename(args[0], newname)
+
+    @staticmethod
+    def unit(prefix):
+        if prefix in 'kK': return 1024
+        elif prefix in 'mM': return 1024 ** 2
+        elif prefix in 'gG': return 1024 ** 3
+        elif prefix in 'tT': return 1024 ** 4
+        elif prefix in 'pP': return 1024 ** 5
+        return None
 
     @staticmethod
     def size(_, args):
         s = FileInfo.cache(args[0]).st_size
         if len(args) == 1:
             return s
-        args = args[1]
-        if args in 'kK': s = s / 1024
-        elif args in 'mM': s = s / 1024 / 1024
-        elif args in 'gG': s = s / 1024 / 1024 / 1024
-        elif args in 'tT': s = s / 1024 / 1024 / 1024 / 1024
-        elif args in 'pP': s = s / 1024 / 1024 / 1024 / 1024 / 1024
-        return s
+        unit = FileInfo.unit(args[1])
+        return s / unit if unit else s
 
     @staticmethod
     def get_time(st_t, fmt):
@@ -112,4 +124,16 @@ class FileInfo(Module):
     def ctime(_, args):
         return FileInfo.get_time(FileInfo.cache(args[0]).st_ctime, args)
 
+    @staticmethod
+    def columns(key, sources, args):
+        """size or time of a batch of sources, one stat each"""
+        stats = [FileInfo.cache(s) for s in sources]
+        if key == 'size':
+            unit = FileInfo.unit(args[0]) if args else None
+            if unit:
+                return numbers([st.st_size / unit for st in stats], 'd')
+            return numbers([st.st_size for st in stats], 'q')
+        attr = 'st_' + key
+        return [FileInfo.get_time(getattr(st, attr), [None] + args) for st in stats]
+
 MODULES.append(FileInfo)
@@ -6,7 +6,10 @@ except:
 
 import datetime
 import logging
+import math
+import resorter.exif
 from resorter.modules.modules import MODULES, Module
+from resorter.utils import COST_READ
 
 EXIF_TAGS = {
   'make': 271,
@@ -58,11 +61,47 @@ FLASH = {
     0x5f: 'Auto, Fired, Red-eye reduction, Return detected',
 }
 
+WANTED = set(EXIF_TAGS.values())
+
+def rational(v):
+    """PIL rationals as (numerator, denominator) tuples"""
+    if isinstance(v, tuple):
+        return tuple(rational(i) for i in v)
+    if hasattr(v, 'numerator') and hasattr(v, 'denominator') and not isinstance(v, int):
+        return (v.numerator, v.denominator)
+    return v
+
+# DCT-II basis of the 8 lowest frequencies over 32 samples, for phash
+DCT = [[math.cos(math.pi * (2 * x + 1) * u / 64) for x in range(32)] for u in range(8)]
+
+def dhash(pixels):
+    """Difference hash of 9x8 grayscale pixels, row by row: is each pixel brighter than its right neighbour."""
+    bits = 0
+    for y in range(8):
+        row = pixels[y * 9:y * 9 + 9]
+        for x in range(8):
+            bits = bits << 1 | (row[x] > row[x + 1])
+    return f'{bits:016x}'
+
+def phash(pixels):
+    """Perceptual hash of 32x32 grayscale pixels: the 8x8 lowest frequencies of their DCT above their median."""
+    rows = [pixels[y * 32:y * 32 + 32] for y in range(32)]
+    # separable DCT: the 8 lowest frequencies of each row, then of each of those columns
+    low = [[sum(c * p for c, p in zip(basis, row)) for basis in DCT] for row in rows]
+    coefficients = [sum(DCT[v][y] * low[y][u] for y in range(32)) for v in range(8) for u in range(8)]
+    median = sorted(coefficients[1:])[31] # without the DC term
+    bits = 0
+    for c in coefficients:
+        bits = bits << 1 | (c > median)
+    return f'{bits:016x}'
+
 def tags(cls):
     return dict(zip(['exif_'+k for k in EXIF_TAGS.keys()], [{'func': cls.exif, 'help': 'EXIF '+k} for k in EXIF_TAGS.keys()]))
 
 class ImageData(Module):
     ready = False
+    cost = COST_READ
+    persistent = True
 
     @classmethod
     def functions(cls):
@@ -71,6 +110,8 @@ class ImageData(Module):
                 'image_width': {'func': cls.width, 'help': r'pixel width'},
                 'image_height': {'func': cls.height, 'help': r'pixel height'},
                 'exif': {'func': cls.exif, 'help': r'True if the file has exif data'},
+                'image_dhash': {'func': cls.hash, 'help': r'difference hash of the image, 16 hex digits. Similar images have hashes differing by a few bits'},
+                'image_phash': {'func': cls.hash, 'help': r'perceptual (DCT) hash of the image, 16 hex digits. Similar images have hashes differing by a few bits'},
             }
             cls.f.update(tags(cls))
             cls.ready = True
@@ -78,19 +119,58 @@ class ImageData(Module):
 
     @classmethod
     def open(cls, f):
+        """size and EXIF_TAGS values of the image, read from the file headers or with PIL"""
+        try:
+            data = resorter.exif.read(f, WANTED)
+            if data is not None:
+                return data
+        except Exception as e:
+            logging.debug(f'reading {f} headers failed: {e!r}')
+        if not OK:
+            return None
         try:
-            return Image.open(f)
+            with Image.open(f) as i:
+                exif = i.getexif()
+                tags = dict(exif)
+                if hasattr(exif, 'get_ifd'):
+                    tags.update(exif.get_ifd(resorter.exif.EXIF_IFD))
+                    if resorter.exif.GPS_IFD in tags:
+                        tags[resorter.exif.GPS_IFD] = {k: rational(v) for k, v in exif.get_ifd(resorter.exif.GPS_IFD).items()}
+                tags = {t: rational(tags[t]) for t in WANTED if t in tags}
+                return {'size': i.size, 'exif': tags}
         except Exception as e:
             logging.warning(e)
             return None
 
+    @staticmethod
+    def pixels(f, width, height):
+        """Grayscale pixels of the image resized to width x height. JPEG images are decoded at a reduced scale."""
+        with Image.open(f) as i:
+            i.draft('L', (width * 4, height * 4)) # JPEG only: DCT scaling, not a full decode
+            i = i.convert('L').resize((width, height), Image.BILINEAR)
+            return list(i.getdata())
+
+    @staticmethod
+    def hash(key, args):
+        if not OK:
+            return None
+        if key == 'image_dhash':
+            compute = lambda f: dhash(ImageData.pixels(f, 9, 8))
+        else:
+            compute = lambda f: phash(ImageData.pixels(f, 32, 32))
+        try:
+            return Module.CACHE.get(f'ImageData.{key}', args[0], compute, True)
+        except Exception as e:
+            logging.warning(f'{key} of {args[0]}: {e}')
+            return None
+
     @staticmethod
     def width(_, args):
-        return ImageData.cache(args[0]).size[0]
+        return ImageData.cache(args[0])['size'][0]
 
     @staticmethod
     def height(_, args):
-        return ImageData.cache(args[0]).size[1]
+        return ImageData.cache(args[0])['size'][1]
 
     @staticmethod
     def exif(key, args):
@@ -101,12 +181,11 @@ class ImageData(Module):
             return None
         key = key[5:]
         value = None
-        if i:
-            t = EXIF_TAGS.get(key, None)
-            if t is not None:
-                v = i.getexif().get(t, None)
-                if v is not None:
-                    value = ImageData.parse_exif(key, v, args)
+        t = EXIF_TAGS.get(key, None)
+        if t is not None:
+            v = i['exif'].get(t, None)
+            if v is not None:
+                value = ImageData.parse_exif(key, v, args)
         return value
 
     @staticmethod
@@ -131,7 +210,7 @@ class ImageData(Module):
             a = value.get(6, None)  #meters
             if a is None: return None
             a = round(a[0]/a[1], 2)
-            return -a if ref else e
+            return -a if ref else a
         elif key == 'speed':
             ref = value.get(12, 'K') # K/M/N
             s = value.get(13, None)
@@ -161,5 +240,4 @@ class ImageData(Module):
         if isinstance(value, str): return value.strip()
         return value
 
-if OK:
-    MODULES.append(ImageData)
+MODULES.append(ImageData)
@@ -7,8 +7,33 @@ except:
 import logging
 import datetime
 from resorter.modules.modules import MODULES, Module
+from resorter.utils import COST_READ, literals
+
+class Limited(object):
+    """Binary file handing out at most `limit` bytes, then reporting its end."""
+    def __init__(self, f, limit):
+        self.f = f
+        self.left = limit
+
+    def read(self, n=-1):
+        if self.left <= 0:
+            return b''
+        data = self.f.read(self.left if n < 0 else min(n, self.left))
+        self.left -= len(data)
+        return data
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+    def tell(self):
+        return self.f.tell()
 
 class Media(Module):
+    cost = COST_READ
+    persistent = True
+    parse_speed = 0.5 # MediaInfo ParseSpeed, lower values read less of the files
+    read_limit = None # bytes of each file given to MediaInfo
+    properties = None # track properties to keep, all if None
 
     @classmethod
     def functions(cls):
@@ -18,9 +43,47 @@ class Media(Module):
                 'args': ['track id or type', 'property'], 'example': 'track["Video","format"]', 'source': 'demo.avi', 'output': 'MPEG-4 Visual'},
             } if MediaInfo.can_parse() else {}
 
+    @classmethod
+    def request(cls, expressions):
+        """Keeps only the track properties the expressions ask for, if all are literal."""
+        wanted = set()
+        for e in expressions:
+            if e.tree is None:
+                cls.properties = None
+                return
+            for root in e.tree:
+                for c in root.calls():
+                    if c.f['func'] is not cls.track:
+                        continue
+                    values = literals(c.args) if c.args is not None else None
+                    if not values:
+                        cls.properties = None
+                        return
+                    wanted.add(values[-1])
+        cls.properties = wanted
+
+    @classmethod
+    def cache(cls, f):
+        name = f'{cls.__name__}[{cls.parse_speed},{cls.read_limit}]' # the settings the tracks are parsed with
+        if cls.properties is not None:
+            name += f'{sorted(cls.properties)}'
+        return Module.CACHE.get(name, f, cls.open, cls.persistent)
+
     @classmethod
     def open(cls, f):
-        return MediaInfo.parse(f)
+        """properties of the tracks, indexed by track id and by track type"""
+        with open(f, 'rb') as source:
+            if cls.read_limit is not None:
+                source = Limited(source, cls.read_limit)
+            media = MediaInfo.parse(source, parse_speed=cls.parse_speed)
+        ids, types = {}, {}
+        for t in media.tracks:
+            data = t.to_data()
+            if cls.properties is not None:
+                data = {k: v for k, v in data.items() if k in cls.properties}
+            ids.setdefault(t.track_id, data)
+            types.setdefault(t.track_type, data)
+        return {'id': ids, 'type': types}
     
     @staticmethod
     def track(_, args):
@@ -32,11 +95,10 @@ class Media(Module):
             n = None
         else:
             n, prop = t
-        for t in media.tracks:
-            if t.track_id != n and t.track_type != n:
-                continue
-            return t.to_data().get(prop, None)
-        return None
+        data = media['id'].get(n, None)
+        if data is None:
+            data = media['type'].get(n, None)
+        return None if data is None else data.get(prop, None)
 
 if OK:
     MODULES.append(Media)
@@ -1,12 +1,122 @@
+import collections
 import os
 import logging
+import re
 import subprocess
 import shlex
+import threading
 import resorter.utils
+from resorter.utils import force, PathEntry, MISSING, COST_STRING, COST_PROCESS
+
+class MetadataCache(object):
+    """Bounded LRU cache of the data the modules open for the files, keyed by (module, path, inode, mtime).
+    The inode and the modification time come from the stat result of the PathEntry a walk or a watch event
+    found the file as, so that a file found again is stat'ed again, and its data reopened if it changed.
+    Evicted data is closed if it has a close() method. The cache is shared by the threads:
+    each file is computed by one thread, so the size should exceed the number of threads.
+    Data of the persistent modules is looked up in the disk cache, if set, before opening the file."""
+
+    def __init__(self, size=128):
+        self.size = size
+        self.disk = None # DiskCache
+        self.data = collections.OrderedDict()
+        self.paths = {} # path -> keys
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def close(data):
+        close = getattr(data, 'close', None)
+        if callable(close):
+            try:
+                close()
+            except Exception as e:
+                logging.debug(f'closing {data!r} failed: {e!r}')
+
+    def lookup(self, key):
+        with self.lock:
+            data = self.data.get(key, MISSING)
+            if data is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+            return data
+
+    def add(self, key, data):
+        evicted = []
+        with self.lock:
+            if key in self.data: # opened by another thread meanwhile
+                evicted.append(data)
+                data = self.data[key]
+            else:
+                self.data[key] = data
+                self.paths.setdefault(key[1], set()).add(key)
+                while len(self.data) > self.size:
+                    k, v = self.data.popitem(last=False)
+                    self.forget(k)
+                    evicted.append(v)
+        for v in evicted:
+            MetadataCache.close(v)
+        return data
+
+    def forget(self, key):
+        keys = self.paths.get(key[1])
+        keys.discard(key)
+        if not keys:
+            del self.paths[key[1]]
+
+    def stat(self, f):
+        """Stat result of the file: the one of the PathEntry, or cached for other names until invalidated."""
+        if isinstance(f, PathEntry):
+            return f.stat()
+        key = ('stat', str(f))
+        st = self.lookup(key)
+        if st is MISSING:
+            st = self.add(key, os.stat(f))
+        return st
+
+    def get(self, module, f, open, persistent=False):
+        """The data open(f) returns for the module."""
+        try:
+            st = self.stat(f)
+            key = (module, str(f), st.st_ino, st.st_mtime_ns)
+        except OSError:
+            st = None
+            key = (module, str(f), None, None)
+        data = self.lookup(key)
+        if data is MISSING:
+            if persistent and self.disk is not None and st is not None:
+                data = self.disk.get(module, st)
+                if data is MISSING:
+                    data = open(f)
+                    self.disk.put(module, st, data)
+            else:
+                data = open(f)
+            data = self.add(key, data)
+        return data
+
+    def invalidate(self, path):
+        """Drops the data of a renamed or rewritten file."""
+        with self.lock:
+            evicted = [self.data.pop(k) for k in self.paths.pop(str(path), ())]
+        for v in evicted:
+            MetadataCache.close(v)
+
+    def clear(self):
+        with self.lock:
+            evicted = list(self.data.values())
+            self.data.clear()
+            self.paths.clear()
+        for v in evicted:
+            MetadataCache.close(v)
 
 class Module(object):
 
-    CACHE = { 'name': None, 'data': None }
+    CACHE = MetadataCache() # data opened by the modules
+    cost = COST_STRING # default cost class of the module functions
+    persistent = False # open() returns plain data worth keeping in the disk cache
 
     @classmethod
     def open(cls, f):
@@ -14,9 +124,7 @@ class Module(object):
 
     @classmethod
     def cache(cls, f):
-        if f != cls.CACHE['name']:
-            cls.CACHE = { 'name': f, 'data': cls.open(f) }
-        return cls.CACHE['data']
+        return Module.CACHE.get(cls.__name__, f, cls.open, cls.persistent)
 
     @staticmethod
     def range(args):
@@ -62,15 +170,40 @@ class Conditions(Module):
     @classmethod
     def functions(cls):
         return {
-                'if': {'func': cls.eef, 'help': r'if-else condition', 'args': ['condition', 'true value', 'false value'], 'example': 'if(len(name)>8,"long","short")'},
-                'any': {'func': cls.aany, 'help': r'true if any of arguments is true', 'args': ['condition', '...']},
-                'all': {'func': cls.aall, 'help': r'true if all of arguments are true', 'args': ['condition', '...']},
-                'in': {'func': cls.een, 'help': r'check agains a list of options', 'args': ['option', '...'], 'example': 'ext.in(".ext",".xls")'},
-                'not': {'func': cls.noot, 'help': r'negation', 'args': ['condition'], 'example': 'not(ext==".jpg")'},
+                'if': {'func': cls.eef, 'lazy': True, 'help': r'if-else condition', 'args': ['condition', 'true value', 'false value'], 'example': 'if(len(name)>8,"long","short")'},
+                'any': {'func': cls.aany, 'lazy': True, 'predicate': True, 'safe': True, 'commutative': True, 'help': r'true if any of arguments is true', 'args': ['condition', '...']},
+                'all': {'func': cls.aall, 'lazy': True, 'predicate': True, 'safe': True, 'commutative': True, 'help': r'true if all of arguments are true', 'args': ['condition', '...']},
+                'in': {'func': cls.een, 'predicate': True, 'safe': True, 'literal': cls.member, 'help': r'check agains a list of options', 'args': ['option', '...'], 'example': 'ext.in(".ext",".xls")'},
+                'not': {'func': cls.noot, 'predicate': True, 'safe': True, 'help': r'negation', 'args': ['condition'], 'example': 'not(ext==".jpg")'},
                 'none': {'func': cls.none, 'help': r'returns none value. If the whole expressions computes to none, the source file is skipped', 'example': 'if(ext==".txt",nam.cap,none)'},
-                'has': {'func': cls.has, 'help': r'return true if some of the arguments present in the source', 'args': [ 'keywords' ], 'example': 'path.has("etc", "path")'},
+                'has': {'func': cls.has, 'predicate': True, 'literal': cls.contains, 'help': r'return true if some of the arguments present in the source', 'args': [ 'keywords' ], 'example': 'path.has("etc", "path")'},
         }
     @staticmethod
+    def member(options):
+        values = tuple(options)
+        try:
+            options = frozenset(options)
+        except TypeError:
+            return None
+        def een(v):
+            try:
+                return v in options
+            except TypeError: # unhashable
+                return v in values
+        return een
+
+    @staticmethod
+    def contains(keywords):
+        if not all(isinstance(k, str) for k in keywords):
+            return None
+        pattern = re.compile('|'.join(re.escape(k) for k in keywords))
+        def has(v):
+            if isinstance(v, str):
+                return pattern.search(v) is not None
+            return any(k in v for k in keywords)
+        return has
+
+    @staticmethod
     def has(_, args):
         if len(args) < 2: raise RuntimeError("Wrong number of arguments")
         return any(a in args[0] for a in args[1:])
@@ -78,20 +211,20 @@ class Conditions(Module):
     def none(_, args):
         return None
     @staticmethod
-    def eef(_, args):
+    def eef(_, args): # lazy: the branches may be thunks, returned uncomputed
         if len(args) == 4: # source -> if(cond,t,f)
-            return args[2] if args[1] else args[3]
+            return args[2] if force(args[1]) else args[3]
         if len(args) == 3: # source -> if(cond,t)
-            return args[2] if args[1] else args[0]
+            return args[2] if force(args[1]) else args[0]
         if len(args) == 2: # source -> if(cond)
-            return args[0] if args[1] else None
+            return args[0] if force(args[1]) else None
         raise RuntimeError("Wrong number of arguments")
     @staticmethod
     def aany(_, args):
-        return any(args[1:])
+        return any(force(a) for a in args[1:])
     @staticmethod
     def aall(_, args):
-        return all(args[1:])
+        return all(force(a) for a in args[1:])
     @staticmethod
     def een(_, args):
         return args[0] in args[1:]
@@ -179,31 +312,33 @@ class Text(Module):
 class Counter(Module):
     count = None
     step = 1
+    lock = threading.Lock()
 
     @classmethod
     def functions(cls):
         return {
-            'counter': {'func': cls.counter, 'help': r'counting number', 'args': ['start', 'step'], 'example': 'nam+"_"+counter[100,10].str+ext'}
+            'counter': {'func': cls.counter, 'pure': False, 'help': r'counting number', 'args': ['start', 'step'], 'example': 'nam+"_"+counter[100,10].str+ext'}
         }
 
     @staticmethod
     def counter(_, args):
-        if Counter.count is None:
-            Counter.count = 0
-            if len(args) > 1:
-                Counter.count = args[1]
-            if len(args) > 2:
-                Counter.step = args[2]
-        else:
-            Counter.count += Counter.step
-        return Counter.count
+        with Counter.lock:
+            if Counter.count is None:
+                Counter.count = 0
+                if len(args) > 1:
+                    Counter.count = args[1]
+                if len(args) > 2:
+                    Counter.step = args[2]
+            else:
+                Counter.count += Counter.step
+            return Counter.count
 
 class Set(Module):
     allowed = False
 
     @classmethod
     def functions(cls):
-        return { 'set': { 'func': resorter.utils.Caller(cls.set), 'help': 'calls the modifier version of a function. Requires use of the `fix` action' } }
+        return { 'set': { 'func': resorter.utils.Caller(cls.set), 'pure': False, 'help': 'calls the modifier version of a function. Requires use of the `fix` action' } }
 
     @staticmethod
     def set(_, args):
@@ -218,6 +353,7 @@ class Set(Module):
 class Custom(Module):
     
     funcs = {}
+    cost = COST_PROCESS
 
     @classmethod
     def functions(cls):
@@ -240,21 +376,31 @@ def example(f):
     if args: text += f'\n\t\tArguments: {args}'
     ex = f.get('example', None)
     if ex:
-        result = f.get('output', None) or resorter.utils.Expression(ex, FUNCTIONS).calc(source)
-        text += f'\n\t\tExample: {source} -> {ex} -> {result}'
+        try:
+            result = f.get('output', None) or resorter.utils.Expression(ex, FUNCTIONS).calc(source)
+        except resorter.utils.FuncError: # needs a real file
+            text += f'\n\t\tExample: {ex}'
+        else:
+            text += f'\n\t\tExample: {source} -> {ex} -> {result}'
     return text
 
 def update():
     logging.debug('registering modules')
     for m in MODULES:
         logging.debug('... {0} ({1})'.format(m.__name__, ', '.join(m.functions())))
-        FUNCTIONS.update(m.functions())
-
-def append(scripts):
+        functions = m.functions()
+        for f in functions.values():
+            f.setdefault('cost', m.cost)
+            f.setdefault('module', m.__name__)
+        FUNCTIONS.update(functions)
+
+def append(scripts, pure=False):
+    """Registers the name=command scripts. Unless pure, they are called each time they are computed,
+    in the order of the expression, and their output is not indexed."""
     for script in scripts:
         name, command = script.split('=', 1)
         logging.debug(f'custom script {name}: {command}')
-        Custom.funcs[name] = {'func': Custom.call, 'help': f'`{command} <source> <args>`', 'args': ['additional command arguments'], 'command': command }
+        Custom.funcs[name] = {'func': Custom.call, 'pure': pure, 'help': f'`{command} <source> <args>`', 'args': ['additional command arguments'], 'command': command }
 
 def list_functions(verbose):
     for m in MODULES:
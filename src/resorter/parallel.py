@@ -0,0 +1,42 @@
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def attempt(compute, ctx):
+    try:
+        return ctx, compute(ctx), None
+    except Exception as e:
+        return ctx, None, e
+
+def run(compute, chunk):
+    return [attempt(compute, ctx) for ctx in chunk]
+
+def evaluate(contexts, compute, jobs=1, chunk=16, ordered=True):
+    """Yields (context, compute(context), None), or (context, None, exception) if compute failed.
+    With several jobs, the contexts are computed by chunks in a thread pool, at most two chunks
+    per thread in flight, and yielded in their order unless `ordered` is False."""
+    if jobs <= 1:
+        for ctx in contexts:
+            yield attempt(compute, ctx)
+        return
+    contexts = iter(contexts)
+    chunks = iter(lambda: list(itertools.islice(contexts, chunk)), [])
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    pending = collections.deque() if ordered else set()
+    try:
+        for c in itertools.islice(chunks, 2 * jobs):
+            (pending.append if ordered else pending.add)(pool.submit(run, compute, c))
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+                c = next(chunks, None)
+                if c is not None:
+                    (pending.append if ordered else pending.add)(pool.submit(run, compute, c))
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
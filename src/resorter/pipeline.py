@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SKIP = object() # the item was dropped by a stage
+STOP = object() # the pipeline is to end
+DONE = object() # end of the items
+HEAD = 4 * 1024 * 1024 # bytes read ahead of the files parsed from their head
+
+def readahead(path, length=HEAD):
+    """Asks the kernel to start reading the first `length` bytes of the file into the page cache,
+    the whole file if 0."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class Stage(object):
+    """Step of a Pipeline: func(item) runs in a thread, `workers` of them at most at a time.
+    It returns the item for the next stage, SKIP to drop it, or STOP to end the pipeline."""
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.count = 0
+        self.busy = 0.0 # seconds spent in func
+
+    def __repr__(self):
+        return f'{self.name}: {self.count} items, {self.busy:.3f} s busy, {self.workers} workers'
+
+class Pipeline(object):
+    """Runs the stages over the items of a blocking iterator, concurrently, with asyncio.
+    The stages are connected by queues of `size` items: a slow stage holds the previous ones back,
+    and memory stays bounded. Items reach each stage in the order of the iterator, unless `ordered`
+    is False: single worker stages then take them in the order the previous stage completes them.
+    An exception raised by the iterator ends the pipeline, and is raised again by run().
+    The iterator runs in a thread of its own which is not waited for: if it may block, `stop` is
+    called when the pipeline ends to wake it, and the iterator is then closed in that thread."""
+
+    def __init__(self, items, stages, size=64, ordered=True, stop=None):
+        self.items = iter(items)
+        self.stop = stop
+        self.stages = stages
+        self.size = size
+        self.ordered = ordered
+        self.walk = Stage('walk', None)
+        self.stopped = False
+        self.error = None
+
+    async def source(self, loop, pool, queue):
+        try:
+            while not self.stopped:
+                start = time.perf_counter()
+                item = await loop.run_in_executor(pool, next, self.items, DONE)
+                self.walk.busy += time.perf_counter() - start
+                if item is DONE:
+                    break
+                self.walk.count += 1
+                future = loop.create_future()
+                future.set_result(item)
+                await queue.put(future)
+        except Exception as e:
+            self.error = e
+        await queue.put(DONE)
+
+    async def stage(self, loop, pool, stage, inq, outq):
+        slots = asyncio.Semaphore(stage.workers)
+        async def work(upstream, previous):
+            item = await upstream
+            if previous is not None: # a single worker takes the items in order
+                await asyncio.wait([previous])
+            if item is SKIP or item is STOP:
+                return item
+            async with slots:
+                if self.stopped:
+                    return SKIP
+                start = time.perf_counter()
+                result = await loop.run_in_executor(pool, stage.func, item)
+                stage.busy += time.perf_counter() - start
+                stage.count += 1
+                if result is STOP:
+                    self.stopped = True
+            return result
+        previous = None
+        while True:
+            upstream = await inq.get()
+            if upstream is DONE:
+                await outq.put(DONE)
+                return
+            task = asyncio.ensure_future(work(upstream, previous))
+            if stage.workers == 1 and self.ordered:
+                previous = task
+            await outq.put(task)
+
+    async def sink(self, queue):
+        while True:
+            future = await queue.get()
+            if future is DONE:
+                return
+            if await future is STOP:
+                self.stopped = True
+                return
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        feed = ThreadPoolExecutor(max_workers=1) # of the iterator, which may block
+        with ThreadPoolExecutor(max_workers=sum(s.workers for s in self.stages)) as pool:
+            queues = [asyncio.Queue(self.size) for _ in range(len(self.stages) + 1)]
+            tasks = [asyncio.ensure_future(self.source(loop, feed, queues[0]))]
+            tasks += [asyncio.ensure_future(self.stage(loop, pool, s, queues[i], queues[i + 1])) for i, s in enumerate(self.stages)]
+            try:
+                await self.sink(queues[-1])
+            finally:
+                self.stopped = True
+                if self.stop is not None:
+                    self.stop()
+                if hasattr(self.items, 'close'): # after the pending next(), in the same thread
+                    feed.submit(self.items.close)
+                feed.shutdown(wait=False)
+                for t in tasks:
+                    t.cancel()
+                for q in queues: # pending work of the stages
+                    while not q.empty():
+                        f = q.get_nowait()
+                        if isinstance(f, asyncio.Future):
+                            f.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        for s in [self.walk] + self.stages:
+            logging.debug(f'stage {s!r}')
+
+    def run(self):
+        asyncio.run(self.main())
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,101 @@
+import logging
+import os
+
+from resorter.utils import Context, Call, Comma, Logic, Precompiled, COST_STRING
+from resorter.modules.modules import Conditions
+from resorter.modules.fileinfo import FileInfo
+
+def name_only(node):
+    """True if the node computes from the file path alone."""
+    return node.pure() and all(c.f.get('cost', COST_STRING) <= COST_STRING for c in node.calls())
+
+def is_func(node, func):
+    return isinstance(node, (Call, Precompiled)) and node.f['func'] is func
+
+def condition(root):
+    """The condition without which the expression computes to None: if(cond) or if(cond, value, none)."""
+    if not is_func(root, Conditions.eef) or root.args is None:
+        return None
+    if not isinstance(root.args, Comma):
+        return root.args
+    items = root.args.items
+    if len(items) == 3 and is_func(items[2], Conditions.none):
+        return items[0]
+    return None
+
+class Pushdown(object):
+    """Rejects files, and whole directories, for which all the expressions are bound to compute to None.
+
+    A file is evaluated on the parts of the conditions depending on its name only.
+    A directory is rejected when the conditions are false for any path beneath it,
+    which is known for path.has(...) and abspath.has(...): once a directory path
+    contains one of the keywords, so do the paths of all the files beneath it."""
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+        self.closures = {}
+
+    def __repr__(self):
+        return ' || '.join(repr(c) for c in self.conditions)
+
+    def closure(self, node):
+        f = self.closures.get(id(node), None)
+        if f is None:
+            f = self.closures[id(node)] = node.compile()
+        return f
+
+    def truth(self, node, ctx, directory):
+        """True or False if known from the path, None otherwise."""
+        if isinstance(node, Logic):
+            a = self.truth(node.a, ctx, directory)
+            if node.op == '&&' and a is False or node.op == '||' and a is True:
+                return a
+            b = self.truth(node.b, ctx, directory)
+            if a is None:
+                return b if (node.op == '&&') != (b is True) else None
+            return b
+        if is_func(node, Conditions.noot) and node.args is not None and not isinstance(node.args, Comma):
+            v = self.truth(node.args, ctx, directory)
+            return None if v is None else not v
+        if (is_func(node, Conditions.aany) or is_func(node, Conditions.aall)) and isinstance(node.args, Comma) \
+                and all(i.predicate() for i in node.args.items):
+            values = [self.truth(i, ctx, directory) for i in node.args.items]
+            decisive = is_func(node, Conditions.aany) # the value deciding any(), negated for all()
+            if decisive in values:
+                return decisive
+            return None if None in values else not decisive
+        if directory:
+            if isinstance(node, Precompiled) and node.f['func'] is Conditions.has and self.prefix(node.subject):
+                return True if self.closure(node)(ctx) else None
+            return None
+        if name_only(node):
+            try:
+                return bool(self.closure(node)(ctx))
+            except Exception as e:
+                logging.debug(f'pushdown of {node!r} failed on {ctx.source}: {e!r}')
+        return None
+
+    @staticmethod
+    def prefix(node):
+        """True if the node value for a file beneath a directory extends its value for a file in the directory."""
+        return (is_func(node, FileInfo.path) or is_func(node, FileInfo.abspath)) and node.subject is None and node.args is None
+
+    def accept(self, path):
+        ctx = Context(path)
+        return any(self.truth(c, ctx, False) is not False for c in self.conditions)
+
+    def descend(self, path):
+        ctx = Context(os.path.join(path, '')) # a file directly in the directory
+        return any(self.truth(c, ctx, True) is not False for c in self.conditions)
+
+def create(expressions):
+    """Pushdown for the expressions, None if some of them may compute for any file."""
+    conditions = []
+    for e in expressions:
+        if not e.tree or len(e.tree) != 1:
+            return None
+        c = condition(e.tree[0])
+        if c is None or not c.pure():
+            return None
+        conditions.append(c)
+    return Pushdown(conditions) if conditions else None
@@ -0,0 +1,99 @@
+import datetime
+import heapq
+import logging
+import math
+import operator
+import pickle
+import sys
+import tempfile
+
+from resorter.utils import Context, PathEntry
+
+MEMORY = 256 * 1024 * 1024 # bytes of keys and paths held before spilling a run
+CHUNK = 4096 # records pickled at once
+
+first = operator.itemgetter(0)
+
+def encode(value):
+    """Sort key of a value. Values of different types compare by type: None first, then numbers,
+    strings, bytes, dates and times, sequences, and anything else by its text."""
+    if value is None:
+        return (0,)
+    if isinstance(value, (bool, int, float)):
+        return (1, math.inf) if value != value else (1, value) # NaN last
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, bytes):
+        return (3, value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return (4, value.isoformat())
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(encode(v) for v in value))
+    return (6, type(value).__name__, str(value))
+
+def keys(expressions):
+    """Function computing the encoded sort key of a context. A value that fails sorts as None."""
+    def key(context):
+        values = []
+        for e in expressions:
+            try:
+                v = e.calc(context)
+            except Exception as ex:
+                logging.warning(f'could not sort {context.source} by {e.expr}: {ex}')
+                v = None
+            values.append(encode(v))
+        return tuple(values)
+    return key
+
+def size(record):
+    """Bytes held by a record of nested tuples."""
+    n = sys.getsizeof(record)
+    if isinstance(record, tuple):
+        n += sum(size(r) for r in record)
+    return n
+
+def spill(run):
+    """Writes a sorted run of (key, path) to a temporary file."""
+    f = tempfile.TemporaryFile()
+    for i in range(0, len(run), CHUNK):
+        pickle.dump(run[i:i + CHUNK], f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def load(f):
+    try:
+        while True:
+            yield from pickle.load(f)
+    except EOFError:
+        pass
+    finally:
+        f.close()
+
+def sort(contexts, key, reverse=False, memory=MEMORY):
+    """Yields new contexts of the paths sorted by key(context), stably. Only the keys and the paths
+    are kept: runs of up to `memory` bytes of them are sorted and spilled to temporary files,
+    then merged as the contexts are consumed."""
+    run, used, runs = [], 0, []
+    for context in contexts:
+        record = (key(context), str(context.source))
+        run.append(record)
+        used += size(record) + 8 # and its slot in the run
+        if used > memory:
+            run.sort(key=first, reverse=reverse)
+            runs.append(spill(run))
+            run, used = [], 0
+    run.sort(key=first, reverse=reverse)
+    if runs:
+        logging.debug(f'merging {len(runs) + 1} sorted runs')
+    files = [load(f) for f in runs]
+    try:
+        for _, path in heapq.merge(*files, run, key=first, reverse=reverse):
+            yield Context(PathEntry(path)) # stat'ed again when needed
+    finally:
+        for f in files:
+            f.close()
+
+def top(contexts, key, n, reverse=False):
+    """The first n contexts sorted by key(context), as sort would yield them, selected with a heap
+    of n of them: O(log n) time per context and O(n) memory."""
+    return (heapq.nlargest if reverse else heapq.nsmallest)(n, contexts, key=key)
@@ -1,30 +1,282 @@
+import collections
+import copy
 import logging
+import queue
 import re
 import os
+import threading
+
+class PathEntry(str): # DirEntry alike
+    """File name carrying the os.DirEntry it was found with, to reuse its stat result."""
+    def __new__(cls, path, entry=None):
+        self = super().__new__(cls, path)
+        self.entry = entry
+        self.st = None
+        return self
+
+    @property
+    def path(self):
+        return str(self)
 
-class PathEntry(object): # DirEntry alike
-    def __init__(self, f):
-        self.path = f
-        self.stat = None
     def stat(self):
-        if self.stat is None:
-            self.stat = os.stat(self.path)
-        return self.stat
+        if self.st is None:
+            self.st = self.entry.stat() if self.entry is not None else os.stat(self)
+            self.entry = None
+        return self.st
 
-def read_filenames(source, recursive):
-    if isinstance(source, str) or isinstance(source, bytes): # dir
-        logging.info(f'scanning directory {source}')
-        source = os.fsencode(source)
-        with os.scandir(source) as it:
+class Walker(object):
+    """Scans directories with several threads. Each thread scans the directory it queued last
+    and, when it has none left, steals the oldest directory queued by another thread."""
+
+    DONE = object()
+
+    def __init__(self, threads, recursive, select=None, prefetch=False):
+        self.threads = threads
+        self.recursive = recursive
+        self.select = select
+        self.prefetch = prefetch # stat the files in the scanning threads
+        self.queues = [collections.deque() for _ in range(threads)]
+        self.lock = threading.Condition()
+        self.pending = 0 # directories queued or being scanned
+        self.stopped = False
+        self.found = queue.Queue(maxsize=1024 * threads)
+
+    def push(self, i, path):
+        with self.lock:
+            self.pending += 1
+            self.queues[i].append(path)
+            self.lock.notify()
+
+    def take(self, i):
+        with self.lock:
+            while not self.stopped:
+                if self.queues[i]:
+                    return self.queues[i].pop()
+                for q in self.queues:
+                    if q:
+                        return q.popleft()
+                if self.pending == 0:
+                    return None
+                self.lock.wait()
+            return None
+
+    def put(self, item):
+        while not self.stopped:
+            try:
+                return self.found.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def scan(self, i, path):
+        with os.scandir(path) as it:
             for entry in it:
                 if not entry.is_dir():
-                    logging.info(f'found {entry.path}')
-                    yield os.fsdecode(entry.path)
-                elif recursive:
-                    logging.debug(f'entering directory {entry.path}')
-                    yield from read_filenames(entry.path, recursive)
+                    name = os.fsdecode(entry.path)
+                    if self.select and not self.select.accept(name):
+                        continue
+                    found = PathEntry(name, entry)
+                    if self.prefetch:
+                        found.stat()
+                    self.put(found)
+                elif self.recursive:
+                    if self.select and not self.select.descend(os.fsdecode(entry.path)):
+                        logging.debug(f'pruning directory {entry.path}')
+                        continue
+                    self.push(i, entry.path)
+
+    def work(self, i):
+        try:
+            while True:
+                path = self.take(i)
+                if path is None:
+                    break
+                try:
+                    self.scan(i, path)
+                except Exception as e:
+                    self.put(e)
+                finally:
+                    with self.lock:
+                        self.pending -= 1
+                        if self.pending == 0:
+                            self.lock.notify_all()
+        finally:
+            self.put(Walker.DONE)
+
+    def walk(self, source):
+        logging.info(f'scanning directory {source} with {self.threads} threads')
+        self.push(0, os.fsencode(source))
+        workers = [threading.Thread(target=self.work, args=(i,), daemon=True) for i in range(self.threads)]
+        for w in workers:
+            w.start()
+        try:
+            running = len(workers)
+            while running:
+                item = self.found.get()
+                if item is Walker.DONE:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
                 else:
-                    logging.info(f'skipping {entry.path}')
+                    yield item
+        finally:
+            with self.lock:
+                self.stopped = True
+                self.lock.notify_all()
+
+def glob(pattern):
+    """Regular expression of a glob pattern, whose * and ? don't match a slash, unlike fnmatch's."""
+    i, n, result = 0, len(pattern), []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[':
+            j = i + 1 if i < n and pattern[i] == '!' else i
+            j = pattern.find(']', j + 1 if j < n and pattern[j] == ']' else j)
+            if j < 0:
+                result.append(re.escape(c))
+                continue
+            chars = re.sub(r'([\\\[&~|])', r'\\\1', pattern[i:j]) # no nested sets nor set operations
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith('^'):
+                chars = '\\' + chars
+            result.append(f'[{chars}]')
+            i = j + 1
+        else:
+            result.append(re.escape(c))
+    return ''.join(result)
+
+def globs(patterns):
+    """Compiles glob patterns into one regular expression matching relative paths.
+    Patterns without a slash match the file name at any depth."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(('' if '/' in p else '(?:.*/)?') + f'(?:{glob(p)})\\Z' for p in patterns), re.S)
+
+class Prune(object):
+    """Walk-time filter for read_filenames: include/exclude globs, depth limit, hidden entries
+    and mount points. Excluded directories are not scanned. Chains to another select, if given."""
+
+    def __init__(self, include=None, exclude=None, max_depth=None, skip_hidden=False, one_file_system=False, select=None):
+        self.patterns = (include or [], exclude or [])
+        self.include = globs(include)
+        self.exclude = globs(exclude)
+        self.max_depth = max_depth # directory levels below the scanned one
+        self.skip_hidden = skip_hidden
+        self.one_file_system = one_file_system
+        self.select = select
+        self.prefix = ''
+        self.device = None
+
+    def __repr__(self):
+        rules = [f'include {self.patterns[0]}' if self.include else None,
+                 f'exclude {self.patterns[1]}' if self.exclude else None,
+                 f'max depth {self.max_depth}' if self.max_depth is not None else None,
+                 'skip hidden' if self.skip_hidden else None,
+                 'one file system' if self.one_file_system else None,
+                 repr(self.select) if self.select else None]
+        return ' && '.join(r for r in rules if r)
+
+    def bind(self, root):
+        """The filter for the directory tree at root."""
+        bound = copy.copy(self)
+        root = os.fsdecode(root)
+        bound.prefix = os.path.join(root, '')
+        if self.one_file_system:
+            bound.device = os.stat(root).st_dev
+        return bound
+
+    def relative(self, path):
+        return path[len(self.prefix):] if path.startswith(self.prefix) else path
+
+    def hidden(self, path):
+        return self.skip_hidden and os.path.basename(path).startswith('.')
+
+    def accept(self, path):
+        if self.hidden(path):
+            return False
+        relative = self.relative(path)
+        if self.exclude and self.exclude.match(relative):
+            return False
+        if self.include and not self.include.match(relative):
+            return False
+        return self.select is None or self.select.accept(path)
+
+    def descend(self, path):
+        if self.hidden(path):
+            return False
+        relative = self.relative(path)
+        if self.exclude and self.exclude.match(relative):
+            return False
+        if self.max_depth is not None and relative.count(os.sep) >= self.max_depth:
+            return False
+        if self.device is not None and os.stat(path).st_dev != self.device:
+            return False
+        return self.select is None or self.select.descend(path)
+
+def scan(source, recursive, select=None):
+    logging.info(f'scanning directory {source}')
+    with os.scandir(source) as it:
+        for entry in it:
+            if not entry.is_dir():
+                path = os.fsdecode(entry.path)
+                if select and not select.accept(path):
+                    logging.debug(f'rejecting {path}')
+                    continue
+                logging.info(f'found {entry.path}')
+                yield PathEntry(path, entry)
+            elif recursive:
+                if select and not select.descend(os.fsdecode(entry.path)):
+                    logging.debug(f'pruning directory {entry.path}')
+                    continue
+                logging.debug(f'entering directory {entry.path}')
+                yield from scan(entry.path, recursive, select)
+            else:
+                logging.info(f'skipping {entry.path}')
+
+def read_lines(stream, separator=b'\n', size=1 << 20):
+    """Yields the names read from a binary or text stream in blocks of up to `size` bytes.
+    Names are separated by `separator`, a trailing carriage return is dropped from newline separated ones."""
+    stream = getattr(stream, 'buffer', stream)
+    read = getattr(stream, 'read1', stream.read) # whatever is available, not waiting for a full block
+    newline = separator == b'\n'
+    rest = b''
+    while True:
+        block = read(size)
+        if not block:
+            break
+        names = (rest + block).split(separator)
+        rest = names.pop()
+        for name in names:
+            if newline and name.endswith(b'\r'):
+                name = name[:-1]
+            if name:
+                yield os.fsdecode(name)
+    if newline and rest.endswith(b'\r'):
+        rest = rest[:-1]
+    if rest:
+        yield os.fsdecode(rest)
+
+def read_filenames(source, recursive, select=None, threads=1, prefetch=False, separator=b'\n', directories=False):
+    """Yields the file names found in a directory, as PathEntry, in a list of names or in a stream.
+    select, if given, has accept(path) and descend(path) methods telling
+    which files to yield and which directories to enter, and optionally bind(root)
+    returning the select for a scanned directory.
+    With several threads, directories are scanned in parallel and the order
+    of the files is not deterministic; prefetch stats the files while scanning.
+    Names read from a stream are `separator` separated, and checked for being
+    directories to scan only if `directories` is set."""
+    if isinstance(source, str) or isinstance(source, bytes): # dir
+        if hasattr(select, 'bind'):
+            select = select.bind(source)
+        if threads > 1:
+            yield from Walker(threads, recursive, select, prefetch).walk(source)
+        else:
+            yield from scan(os.fsencode(source), recursive, select)
     elif isinstance(source, list):
         logging.debug(f'reading lines from {source}')
         for line in source:
@@ -32,9 +284,16 @@ def read_filenames(source, recursive):
             if len(line) == 0: continue
             logging.info(f'found {line}')
             if os.path.isdir(line):
-                yield from read_filenames(line, recursive)
-            else:
-                yield line
+                yield from read_filenames(line, recursive, select, threads, prefetch)
+            elif not select or select.accept(line):
+                yield PathEntry(line)
+    elif hasattr(source, 'read'): # stream
+        logging.debug(f'reading names from {source}')
+        for name in read_lines(source, separator):
+            if directories and os.path.isdir(name):
+                yield from read_filenames(name, recursive, select, threads, prefetch)
+            elif not select or select.accept(name):
+                yield PathEntry(name)
 
 def unescape(s):
     return s.replace(r'\t', '\t').replace(r'\r', '\r').replace(r'\n', '\n').replace(r'\'', '\'').replace(r'\"', '"')
@@ -153,6 +412,10 @@ class FuncB(object):
     def __repr__(self):
         return f'Function_{self.name}({self.args})'
 
+    @property
+    def help(self):
+        return self.func.get('help', None)
+
     def call(self):
         if self.args[0] is None: return None
         try:
@@ -162,6 +425,18 @@ class FuncB(object):
         except Exception as e:
             raise FuncError(e, self)
 
+class Thunk(FuncB):
+    """Argument of a 'lazy' function, computed only when forced."""
+    def __init__(self, f, ctx):
+        self.f = f
+        self.ctx = ctx
+
+    def __repr__(self):
+        return f'Thunk({self.ctx!r})'
+
+    def call(self):
+        return self.f(self.ctx)
+
 class Caller(object):
     def __init__(self, func):
         self.func = func
@@ -169,8 +444,564 @@ class Caller(object):
     def __call__(self, name, args):
         return self.func(name, args)
 
+def force(value):
+    while isinstance(value, FuncB):
+        value = value.call()
+    return value
+
+def bind(name, f, args):
+    b = FuncB(name, f)
+    b.args = args
+    return b
+
+def number(a):
+    if type(a) not in [int, float]:
+        a = str(a)
+        a = (float if '.' in a else int)(a)
+    return a
+
+def regex(a, b):
+    return True if re.fullmatch(str(b), str(a)) else False
+
+def arithmetic(op, numeric):
+    def f(a, b):
+        if type(a) in (int, float) and type(b) in (int, float):
+            return numeric(a, b)
+        if not isinstance(a, str): a = str(a)
+        if not isinstance(b, str): b = str(b)
+        if op == '+':
+            return a + b
+        elif op in '/\\':
+            return a + os.sep + b
+        return a + op + b
+    return f
+
+BINARY = {
+        ':': lambda a, b: str(a) + str(b),
+        '<': lambda a, b: a < b,
+        '>': lambda a, b: a > b,
+        '=': lambda a, b: a == b,
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<>': lambda a, b: a != b,
+        '>=': lambda a, b: a >= b,
+        '<=': lambda a, b: a <= b,
+        '~=': regex,
+        '+': arithmetic('+', lambda a, b: a + b),
+        '-': arithmetic('-', lambda a, b: a - b),
+        '*': arithmetic('*', lambda a, b: a * b),
+        '/': arithmetic('/', lambda a, b: a / b),
+        '%': arithmetic('%', lambda a, b: a % b),
+        '^': arithmetic('^', lambda a, b: a ** b),
+        '|': arithmetic('|', lambda a, b: a | b),
+        '&': arithmetic('&', lambda a, b: a & b),
+        }
+
+# Function cost classes, the relative price of one call
+COST_STRING = 1     # computed from the path or the arguments
+COST_STAT = 10      # stat() of the source file
+COST_READ = 100     # opens the source file to read metadata
+COST_PROCESS = 1000 # runs an external command
+COST_NAMES = {COST_STRING: 'string', COST_STAT: 'stat', COST_READ: 'read', COST_PROCESS: 'process'}
+
+class CompileError(Exception):
+    pass
+
+class Context(object):
+    """Evaluation frame of one source file, shared by all the expressions computed for it.
+    Compiled expressions keep no other per-evaluation state: one Expression may compute
+    several Contexts from several threads, as long as each Context is used by one thread."""
+    def __init__(self, source):
+        self.source = source
+        self.memo = {}
+
+    def __repr__(self):
+        return f'Context({self.source!r})'
+
+MISSING = object()
+
+def memoized(key, f):
+    def call(ctx):
+        v = ctx.memo.get(key, MISSING)
+        if v is MISSING:
+            v = ctx.memo[key] = f(ctx)
+        return v
+    return call
+
+class Node(object):
+    """Expression tree node. compile() returns a callable computing the node value for a Context."""
+    pending = False # the interpreter would keep an uncalled FuncB on the stack
+    fields = () # attributes holding the child nodes
+
+    @property
+    def key(self):
+        return repr(self)
+
+    def children(self):
+        return [c for c in (getattr(self, f) for f in self.fields) if c is not None]
+
+    def pure(self):
+        return all(c.pure() for c in self.children())
+
+    def count(self, counts):
+        """Counts the pure sub-trees, each distinct one descended once."""
+        if not self.pure():
+            for c in self.children():
+                c.count(counts)
+            return
+        key = self.key
+        counts[key] += 1
+        if counts[key] == 1:
+            for c in self.children():
+                c.count(counts)
+
+    def calls(self):
+        for c in self.children():
+            yield from c.calls()
+
+    def cost(self):
+        return sum(c.f.get('cost', COST_STRING) for c in self.calls())
+
+    def predicate(self):
+        """True if the node computes a boolean."""
+        return False
+
+    def boolean(self):
+        """True if the node computes True or False, never None."""
+        return False
+
+    def safe(self):
+        """True if computing the node cannot raise."""
+        return False
+
+    def compile(self, shared=()):
+        f = self.closure(shared)
+        return memoized(self.key, f) if self.key in shared else f
+
+    def closure(self, shared):
+        raise NotImplementedError
+
+    def lazy(self, shared):
+        """Like compile(), but leaves pending `set` calls uncalled, as the interpreter does for lists."""
+        return self.compile(shared)
+
+class Const(Node):
+    def __init__(self, value):
+        self.value = value
+    def __repr__(self):
+        return repr(self.value)
+    def count(self, counts):
+        pass
+    def safe(self):
+        return True
+    def closure(self, shared):
+        value = self.value
+        return lambda ctx: value
+
+class Call(Node):
+    fields = ('subject', 'args')
+
+    def __init__(self, name, f, subject=None, args=None, pending=True):
+        self.name = name
+        self.f = f
+        self.subject = subject
+        self.args = args
+        self.pending = pending
+        self.caller = isinstance(f['func'], Caller)
+
+    def __repr__(self):
+        text = self.name
+        if self.subject is not None:
+            text = f'{self.subject!r}.{text}'
+        if self.args is not None:
+            args = self.args.items if isinstance(self.args, Comma) else [self.args]
+            text += '(' + ', '.join(repr(a) for a in args) + ')'
+        return text
+
+    def pure(self):
+        return self.f.get('pure', True) and super().pure()
+
+    def calls(self):
+        yield self
+        yield from super().calls()
+
+    def predicate(self):
+        return self.f.get('predicate', False)
+
+    def boolean(self):
+        return self.predicate() and self.subject is None # a None subject makes the call None
+
+    def safe(self):
+        if self.args is not None and not self.predicate(): # e.g. a range that is no number
+            return False
+        return self.f.get('safe', False) and all(c.safe() for c in self.children())
+
+    def arguments(self, shared):
+        if self.subject is None:
+            subject = lambda ctx: ctx.source
+        elif self.caller:
+            subject = self.subject.thunk(shared) if self.subject.pending else self.subject.compile(shared)
+        else:
+            subject = self.subject.compile(shared)
+        if self.args is None:
+            return lambda ctx: [subject(ctx)]
+        if self.f.get('lazy', False) and isinstance(self.args, Comma):
+            # the first argument is always needed, the others are passed as thunks
+            first = self.args.items[0].lazy(shared)
+            rest = [i.lazy(shared) for i in self.args.items[1:]]
+            def arguments(ctx):
+                a = [subject(ctx)]
+                v = first(ctx)
+                (a.extend if isinstance(v, list) else a.append)(v)
+                a.extend(Thunk(f, ctx) for f in rest)
+                return a
+            return arguments
+        args = self.args.compile(shared)
+        def arguments(ctx):
+            a = [subject(ctx)]
+            v = args(ctx)
+            (a.extend if isinstance(v, list) else a.append)(v)
+            return a
+        return arguments
+
+    def thunk(self, shared):
+        name, f, arguments = self.name, self.f, self.arguments(shared)
+        return lambda ctx: bind(name, f, arguments(ctx))
+
+    def lazy(self, shared):
+        return self.thunk(shared) if self.pending and self.caller else self.compile(shared)
+
+    def closure(self, shared):
+        name, f, func = self.name, self.f, self.f['func']
+        arguments = self.arguments(shared)
+        def call(ctx):
+            args = arguments(ctx)
+            if args[0] is None: return None
+            try:
+                v = func(name, args)
+            except FuncError:
+                raise
+            except Exception as e:
+                raise FuncError(e, bind(name, f, args))
+            return force(v) if isinstance(v, FuncB) else v
+        if not f.get('pure', True) or f.get('lazy', False):
+            return call
+        def memo(ctx):
+            args = arguments(ctx)
+            if args[0] is None: return None
+            key = (name, *args)
+            try:
+                v = ctx.memo.get(key, MISSING)
+            except TypeError: # unhashable arguments
+                key, v = None, MISSING
+            if v is MISSING:
+                try:
+                    v = func(name, args)
+                except Exception as e:
+                    raise FuncError(e, bind(name, f, args))
+                if isinstance(v, FuncB):
+                    v = force(v)
+                if key is not None:
+                    ctx.memo[key] = v
+            return v
+        return memo
+
+class Neg(Node):
+    fields = ('a',)
+    def __init__(self, a):
+        self.a = a
+    def __repr__(self):
+        return f'-{self.a!r}'
+    def closure(self, shared):
+        a = self.a.compile(shared)
+        return lambda ctx: -number(a(ctx))
+
+class Prefix(Node):
+    fields = ('a',)
+    def __init__(self, op, a):
+        self.op = op
+        self.a = a
+    def __repr__(self):
+        return f'{self.op}{self.a!r}'
+    def closure(self, shared):
+        op, a = self.op, self.a.compile(shared)
+        return lambda ctx: op + a(ctx)
+
+class Attr(Node):
+    fields = ('a', 'b')
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+    def __repr__(self):
+        return f'{self.a!r}.{self.b!r}'
+    def closure(self, shared):
+        a, b = self.a.compile(shared), self.b.compile(shared)
+        return lambda ctx: a(ctx) + '.' + b(ctx)
+
+class Logic(Node):
+    fields = ('a', 'b')
+    def __init__(self, op, a, b):
+        self.op = op
+        self.a = a
+        self.b = b
+    def __repr__(self):
+        return f'({self.a!r} {self.op} {self.b!r})'
+    def predicate(self):
+        return self.a.predicate() and self.b.predicate()
+    def boolean(self):
+        return self.a.boolean() and self.b.boolean()
+    def safe(self):
+        return self.a.safe() and self.b.safe()
+    def closure(self, shared):
+        a, b = self.a.compile(shared), self.b.compile(shared)
+        if self.op == '||':
+            return lambda ctx: a(ctx) or b(ctx)
+        return lambda ctx: a(ctx) and b(ctx)
+
+class BinOp(Node):
+    fields = ('a', 'b')
+    def __init__(self, op, a, b):
+        self.op = op
+        self.a = a
+        self.b = b
+    def __repr__(self):
+        return f'({self.a!r} {self.op} {self.b!r})'
+    def predicate(self):
+        return self.op in COMP
+    def boolean(self):
+        return self.op in COMP
+    def safe(self):
+        return self.op in ('=', '==', '!=', '<>', '~=') and self.a.safe() and self.b.safe()
+    def closure(self, shared):
+        op, a, b = BINARY[self.op], self.a.compile(shared), self.b.compile(shared)
+        return lambda ctx: op(a(ctx), b(ctx))
+
+class Comma(Node):
+    def __init__(self, items):
+        self.items = items
+    def __repr__(self):
+        return '(' + ', '.join(repr(i) for i in self.items) + ')'
+    def children(self):
+        return self.items
+    def closure(self, shared):
+        first, rest = self.items[0].lazy(shared), [i.lazy(shared) for i in self.items[1:]]
+        def comma(ctx):
+            v = first(ctx)
+            result = list(v) if isinstance(v, list) else [v]
+            for f in rest:
+                result.append(f(ctx))
+            return result
+        return comma
+
+class Match(Node):
+    """`~=` against a literal pattern, compiled once."""
+    fields = ('a',)
+    def __init__(self, a, pattern):
+        self.a = a
+        self.pattern = pattern
+    def __repr__(self):
+        return f'({self.a!r} ~= re{self.pattern.pattern!r})'
+    def predicate(self):
+        return True
+    def boolean(self):
+        return True
+    def safe(self):
+        return self.a.safe()
+    def closure(self, shared):
+        a, fullmatch = self.a.compile(shared), self.pattern.fullmatch
+        return lambda ctx: True if fullmatch(str(a(ctx))) else False
+
+class Precompiled(Node):
+    """Call of a function with literal arguments, replaced with the matcher built by its 'literal' factory."""
+    fields = ('subject',)
+    def __init__(self, call, values, matcher):
+        self.name = call.name
+        self.f = call.f
+        self.subject = call.subject
+        self.values = values
+        self.matcher = matcher
+    def __repr__(self):
+        text = self.name if self.subject is None else f'{self.subject!r}.{self.name}'
+        return text + '{' + ', '.join(repr(v) for v in self.values) + '}'
+    def pure(self):
+        return self.f.get('pure', True) and super().pure()
+    def calls(self):
+        yield self
+        yield from super().calls()
+    def predicate(self):
+        return self.f.get('predicate', False)
+    def boolean(self):
+        return self.predicate() and self.subject is None
+    def safe(self):
+        return self.f.get('safe', False) and all(c.safe() for c in self.children())
+    def closure(self, shared):
+        name, f, values, matcher = self.name, self.f, self.values, self.matcher
+        subject = (lambda ctx: ctx.source) if self.subject is None else self.subject.compile(shared)
+        def call(ctx):
+            v = subject(ctx)
+            if v is None: return None
+            try:
+                return matcher(v)
+            except Exception as e:
+                raise FuncError(e, bind(name, f, [v] + values))
+        return call
+
+FOLDABLE = (Neg, Prefix, Attr, BinOp, Match)
+
+def literals(node):
+    """Values of a literal argument list, None if some argument is computed."""
+    items = node.items if isinstance(node, Comma) else [node]
+    if all(isinstance(i, Const) for i in items):
+        return [i.value for i in items]
+    return None
+
+def rewrite(node, f):
+    """Applies f bottom-up, replacing each node with the result."""
+    for field in node.fields:
+        child = getattr(node, field)
+        if child is not None:
+            setattr(node, field, rewrite(child, f))
+    if isinstance(node, Comma):
+        node.items = [rewrite(i, f) for i in node.items]
+    return f(node)
+
+def fold(node):
+    if isinstance(node, BinOp) and node.op == '~=' and isinstance(node.b, Const):
+        try:
+            node = Match(node.a, re.compile(str(node.b.value)))
+        except re.error as e:
+            logging.debug(f'not precompiling {node!r}: {e}')
+    if isinstance(node, FOLDABLE) and all(isinstance(c, Const) for c in node.children()):
+        try:
+            return Const(node.compile()(Context(None)))
+        except Exception as e:
+            logging.debug(f'not folding {node!r}: {e}')
+    elif isinstance(node, Logic) and isinstance(node.a, Const) and not getattr(node.b, 'caller', False):
+        taken = bool(node.a.value) == (node.op == '||')
+        return node.a if taken else node.b
+    elif isinstance(node, Call) and node.args is not None and 'literal' in node.f:
+        values = literals(node.args)
+        matcher = values and node.f['literal'](values)
+        if matcher:
+            return Precompiled(node, values, matcher)
+    return node
+
+def chain(node, op):
+    if isinstance(node, Logic) and node.op == op:
+        return chain(node.a, op) + chain(node.b, op)
+    return [node]
+
+def cheapest(nodes):
+    """The nodes sorted by cost, stably, between the nodes which may raise. Those stay in place:
+    the same nodes are computed before them, so they raise, or are skipped, as they were."""
+    result, safe = [], []
+    for n in nodes:
+        if n.safe():
+            safe.append(n)
+        else:
+            result += sorted(safe, key=lambda n: n.cost()) + [n]
+            safe = []
+    return result + sorted(safe, key=lambda n: n.cost())
+
+def cheapest_first(node):
+    if isinstance(node, Logic):
+        op, operands = node.op, chain(node, node.op)
+        if all(n.boolean() and n.pure() for n in operands): # || and && of booleans commute
+            operands = cheapest(operands)
+            node = operands[0]
+            for b in operands[1:]:
+                node = Logic(op, node, b)
+    elif isinstance(node, Call) and node.f.get('commutative', False) and isinstance(node.args, Comma):
+        if all(n.predicate() and n.pure() for n in node.args.items): # any() and all() return booleans
+            node.args.items = cheapest(node.args.items)
+    return node
+
+def optimize(node):
+    """Folds constant operators and precompiles literal regular expressions and argument lists."""
+    return rewrite(node, fold)
+
+def reorder(node):
+    """Moves the cheapest operands of && and || chains and of commutative functions first.
+    Only operands computing True or False without side effects are moved, and none past
+    an operand which may raise, so that the result, or the error, stays the same."""
+    return rewrite(node, cheapest_first)
+
+ARGS_MARKER = object()
+
+def tree(polish):
+    """Turns a polish list into a list of Node trees, replaying the stack effects of Expression.interpret."""
+    stack = []
+    def pop():
+        if not stack or stack[-1] is ARGS_MARKER:
+            raise CompileError('unexpected arguments or missing operand')
+        return stack.pop()
+    for kind, value in polish:
+        if kind == 'OP':
+            if value == '--':
+                stack.append(Neg(pop()))
+            elif not stack:
+                stack.append(Const(value))
+            elif len(stack) < 2:
+                stack.append(Prefix(value, pop()))
+            elif value == '.':
+                b, a = pop(), pop()
+                if isinstance(b, Call) and b.pending:
+                    stack.append(Call(b.name, b.f, a, b.args, b.caller))
+                else:
+                    stack.append(Attr(a, b))
+            elif value in LOGIC:
+                b, a = pop(), pop()
+                stack.append(Logic(value, a, b))
+            elif value == ',':
+                b, a = pop(), pop()
+                stack.append(Comma((a.items if isinstance(a, Comma) else [a]) + [b]))
+            elif value in BINARY:
+                b, a = pop(), pop()
+                stack.append(BinOp(value, a, b))
+            else:
+                raise CompileError(f'unknown operator {value!r}')
+        elif kind == 'ARGS':
+            stack.append(ARGS_MARKER)
+        elif kind == 'FUNC':
+            args = None
+            if stack and stack[-1] is ARGS_MARKER:
+                stack.pop()
+                args = pop()
+            stack.append(Call(value.name, value.func, None, args))
+        else:
+            stack.append(Const(value))
+    if ARGS_MARKER in stack:
+        raise CompileError('unexpected arguments')
+    stack.reverse()
+    return stack
+
+def compile_tree(roots, shared=()):
+    if len(roots) == 1:
+        return roots[0].compile(shared)
+    calls = [r.compile(shared) for r in roots]
+    return lambda ctx: [c(ctx) for c in calls]
+
+def shared_keys(expressions):
+    """Keys of the sub-trees found more than once within or across the expressions."""
+    counts = collections.Counter()
+    for e in expressions:
+        for root in e.tree or []:
+            root.count(counts)
+    return { k for k, n in counts.items() if n > 1 }
+
+def share(expressions, roots=False):
+    """Recompiles the expressions so that their common sub-trees are computed once per Context.
+    With roots, whole expressions are memoized too, so that values computed beforehand are picked up."""
+    shared = shared_keys(expressions)
+    if roots:
+        shared |= { r.key for e in expressions for r in e.tree or [] }
+    logging.debug(f'common sub-expressions: {shared}')
+    for e in expressions:
+        e.compile(shared)
+    return shared
+
 class Expression(object):
-    def __init__(self, expr, keywords):
+    def __init__(self, expr, keywords, compiled=True):
         self.keywords = keywords
         self.expr = expr
         tokens = tokenize(expr, keywords.keys())
@@ -182,8 +1013,51 @@ class Expression(object):
                 f = keywords[value.name]
                 kv[1] = FuncB(value.name, f)
                 logging.debug(f'found FUNC {value.name}: {kv[1]!r}')
+        self.tree = None
+        self.compiled = None
+        if compiled:
+            try:
+                self.tree = [reorder(optimize(root)) for root in tree(self.polish)]
+            except CompileError as e:
+                logging.info(f'falling back to the interpreter for {expr!r}: {e}')
+            else:
+                self.compile(shared_keys([self]))
+
+    def compile(self, shared=()):
+        if self.tree is not None:
+            self.compiled = compile_tree(self.tree, shared)
+            logging.debug(f'compiled {self.explain()}')
+
+    def pure(self):
+        """True if the expression computes the same values for the same file, without side effects."""
+        if self.tree is not None:
+            return all(root.pure() for root in self.tree)
+        return all(v.func.get('pure', True) for kind, v in self.polish if kind == 'FUNC')
+
+    def explain(self):
+        """The optimized form of the expression, or the polish list when it is interpreted."""
+        if self.tree is None:
+            return f'interpreted {self.polish!r}'
+        return ' '.join(repr(root) for root in self.tree)
+
+    def backends(self):
+        """Modules whose functions do more than string work, with their most expensive cost class."""
+        result = {}
+        for root in self.tree or []:
+            for c in root.calls():
+                cost = c.f.get('cost', COST_STRING)
+                module = c.f.get('module', None)
+                if cost > COST_STRING and module and cost > result.get(module, 0):
+                    result[module] = cost
+        return { m: COST_NAMES.get(c, c) for m, c in result.items() }
 
     def calc(self, source):
+        ctx = source if isinstance(source, Context) else Context(source)
+        if self.compiled is not None:
+            return self.compiled(ctx)
+        return self.interpret(ctx.source)
+
+    def interpret(self, source):
         logging.debug(f'running expression calculation on {source}')
         result = []
         class Args(): pass
@@ -308,8 +1182,7 @@ class Expression(object):
                     a = callf(result.pop()) # arguments values
                     logging.debug(f'args on stack: {a}')
                     (args.extend if isinstance(a, list) else args.append)(a)
-                value.args = args
-                result.append(value)
+                result.append(bind(value.name, value.func, args)) # the polish list stays untouched
             else:
                 logging.debug(f'adding {value}')
                 result.append(value)
@@ -0,0 +1,153 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select as poll
+import struct
+import threading
+
+from resorter.utils import scan, PathEntry
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct('iIII') # wd, mask, cookie, len, followed by the name
+
+class Inotify(object):
+    """Linux inotify through ctypes."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.paths = {} # watch descriptor -> directory
+
+    def watch(self, path, mask):
+        path = os.fsencode(path)
+        wd = self.add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.paths[wd] = path
+
+    def events(self, timeout=None, wake=None):
+        """Yields (path, mask) of the events read within timeout seconds, (None, mask) if some were lost.
+        Returns early if the `wake` file descriptor becomes readable."""
+        ready, _, _ = poll.select([self.fd] + ([wake] if wake is not None else []), [], [], timeout)
+        if self.fd not in ready:
+            return
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                yield None, mask
+            elif mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif wd in self.paths:
+                yield os.fsdecode(os.path.join(self.paths[wd], name)), mask
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher(object):
+    """Yields batches of the files written or moved into a directory, starting with the files already there.
+    Events are collected until none came for `debounce` seconds, or `size` files are found.
+    stop() ends the batches from another thread, even while waiting for events."""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, root, recursive, select=None, debounce=1.0, size=10000):
+        self.root = root
+        self.recursive = recursive
+        self.select = select.bind(root) if hasattr(select, 'bind') else select
+        self.debounce = debounce
+        self.size = size
+        self.inotify = Inotify()
+        self.add(os.fsencode(root))
+        self.wake = os.pipe() # written to by stop()
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.closed = False
+
+    def add(self, path):
+        """Watches the directory, and its subdirectories if recursive."""
+        logging.debug(f'watching {path}')
+        self.inotify.watch(path, Watcher.MASK)
+        if not self.recursive:
+            return
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False) and \
+                        (not self.select or self.select.descend(os.fsdecode(entry.path))):
+                    self.add(entry.path)
+
+    def event(self, path, mask, batch):
+        if mask & IN_ISDIR:
+            if self.recursive and (not self.select or self.select.descend(path)):
+                self.add(path)
+                # the files written before the directory was watched
+                for f in scan(os.fsencode(path), True, self.select):
+                    batch[str(f)] = None
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            if not self.select or self.select.accept(path):
+                batch[path] = None
+
+    def stop(self):
+        """Ends the batches: the batch being collected is dropped."""
+        with self.lock:
+            self.stopped = True
+            if not self.closed:
+                os.write(self.wake[1], b'\0')
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.inotify.close()
+                for fd in self.wake:
+                    os.close(fd)
+
+    def batches(self):
+        try:
+            yield list(scan(os.fsencode(self.root), self.recursive, self.select))
+            while not self.stopped:
+                batch = {} # ordered set
+                timeout = None
+                while len(batch) < self.size:
+                    events = list(self.inotify.events(timeout, self.wake[0]))
+                    if self.stopped:
+                        return
+                    if not events:
+                        if batch:
+                            break
+                        continue
+                    for path, mask in events:
+                        if path is None:
+                            logging.warning('inotify queue overflow, rescanning')
+                            batch.update((str(f), None) for f in scan(os.fsencode(self.root), self.recursive, self.select))
+                        else:
+                            self.event(path, mask, batch)
+                    timeout = self.debounce
+                logging.info(f'{len(batch)} files arrived')
+                yield [PathEntry(p) for p in batch] # stat'ed again
+        except KeyboardInterrupt:
+            logging.info('stopped watching')
+        finally:
+            self.close()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Expression evaluation throughput, files per second.
+
+Usage: python tests/bench.py [number of files]
+"""
+import sys
+import time
+
+import resorter.utils
+from resorter.modules import modules
+
+EXPRESSIONS = [
+    r'name',
+    r'nam.up+ext',
+    r'if(ext.low==".jpg", path/nam+"_"+name[0,3]+ext, none)',
+    r'(path.split,ext).join["-"]',
+    r'if(name ~= "photo_[0-9]+\.(jpe?g|png)" && path.has("1", "2"), nam.len*(1024*1024), none)',
+]
+
+def files(n):
+    exts = ['.jpg', '.JPG', '.png', '.txt', '.mp4']
+    return [f'archive/{i % 97}/photo_{i}{exts[i % len(exts)]}' for i in range(n)]
+
+def rate(calc, names):
+    start = time.perf_counter()
+    for name in names:
+        calc(name)
+    return len(names) / (time.perf_counter() - start)
+
+def main():
+    modules.update()
+    names = files(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
+    print(f'{"expression":56} {"interpreter":>12} {"compiled":>12}')
+    for text in EXPRESSIONS:
+        e = resorter.utils.Expression(text, modules.FUNCTIONS)
+        before = rate(e.interpret, names)
+        after = rate(e.calc, names)
+        print(f'{text:56} {before:12.0f} {after:12.0f}  x{after / before:.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""ID3 tag reading throughput on a synthetic MP3 corpus, files per second.
+
+Usage: python tests/bench_id3.py [number of files]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import resorter.id3
+
+try:
+    import stagger
+    OK = True
+except:
+    OK = False
+
+def syncsafe(n):
+    return bytes([n >> 21 & 0x7f, n >> 14 & 0x7f, n >> 7 & 0x7f, n & 0x7f])
+
+def mp3(i):
+    """ID3v2.3 tag with the usual text frames and 64 KB of cover art, then some audio frames"""
+    frames = [
+        (b'TIT2', f'Track title {i}'),
+        (b'TPE1', f'Artist {i % 300}'),
+        (b'TALB', f'Album {i % 1000}'),
+        (b'TCOM', 'Composer'),
+        (b'TCON', '(17)'),
+        (b'TRCK', f'{i % 12 + 1}/12'),
+        (b'TPOS', '1/1'),
+    ]
+    body = b''.join(fid + len(b'\1' + text.encode('utf-16')).to_bytes(4, 'big') + b'\0\0' + b'\1' + text.encode('utf-16')
+                    for fid, text in frames)
+    cover = b'\0image/jpeg\0\3\0' + b'\xff' * 65536
+    body += b'APIC' + len(cover).to_bytes(4, 'big') + b'\0\0' + cover + b'\0' * 1024
+    return b'ID3\3\0\0' + syncsafe(len(body)) + body + b'\xff\xfb\x90\x64' * 4096
+
+def rate(read, names):
+    start = time.perf_counter()
+    for name in names:
+        read(name)
+    return len(names) / (time.perf_counter() - start)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as d:
+        names = []
+        for i in range(n):
+            names.append(os.path.join(d, f'{i}.mp3'))
+            with open(names[-1], 'wb') as f:
+                f.write(mp3(i))
+        print(f'{"native":>12} {rate(resorter.id3.read, names):12.0f}')
+        if OK:
+            print(f'{"stagger":>12} {rate(stagger.read_tag, names):12.0f}')
+        else:
+            print(f'{"stagger":>12} {"not installed":>12}')
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,36 @@
 import unittest
 import os
 import logging
+import sys
+import hashlib
+import math
+import random
+import contextlib
+import io
+import itertools
+import struct
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import resorter.utils
+import resorter.actions.dupes
+import resorter.actions.similar
+import resorter.batch
+import resorter.parallel
+import resorter.pipeline
+import resorter.exif
+import resorter.id3
+import resorter.diskcache
+import resorter.index
+import resorter.pushdown
+import resorter.sort
+import resorter.watch
 from resorter.modules import modules
+import resorter.modules.image
+import resorter.modules.media
+from resorter.modules.media import Media
 
 def ask_test(msg, opts, default=None):
     return default
@@ -363,6 +390,824 @@ class TestExpressions(unittest.TestCase):
             result = process(files, expr, ask_test)
             self.assertEqual(expected, list(result));
 
+class TestCompile(unittest.TestCase):
+    def test_same_as_interpreter(self):
+        name = 'some/path/name_42.ext'
+        expressions = [
+                r'name', r'{path}', r'nam.up+ext', r'name[0,4]', r'name.sub[5,7].num+1.5',
+                r'-2^3', r'2*(-1)', r'/name', r'nam-ext', r'name:len+xx', r'nam.ext', r'nam.txt',
+                r'path.split', r'(path,ext).join["x"]', r'(path.split,ext).join', r'name.replace["e","E"]',
+                r'if(ext=="ext", 12, 14)', r'if(ext==".ext", nam, none)', r'if(name~="n.*t", 1)',
+                r'name.if(ext!=".ext")', r'name.in("a", name)', r'any(0, nam=="name_42")',
+                r'all(1, 0)', r'not(2>1)', r'ext==".ext" || 7', r'ext=="x" && name', r'2<>2',
+                r'name.has("42", "xx")', r'(name[5,7].round-1)%4', r'nam ext',
+                r'ext.in(".jpg", ".ext")', r'path.split.in("path")', r'path.split.has("some")',
+                r'if(ext ~= "\.(jpe?g|ext)", 1024*1024, "/srv/"+"photos")', r'0 || nam', r'1 && 2>3',
+                r'none.has("C") || ext==".jpg"', r'none.in("a") || ext=="x"', r'none.has("C") && ext==".ext"',
+                ]
+        for expr in expressions:
+            e = resorter.utils.Expression(expr, modules.FUNCTIONS)
+            self.assertIsNotNone(e.compiled, expr)
+            self.assertEqual(e.interpret(name), e.calc(name), expr)
+
+    def test_fallback(self):
+        e = resorter.utils.Expression(r'name', modules.FUNCTIONS, compiled=False)
+        self.assertIsNone(e.compiled)
+        self.assertEqual('name.ext', e.calc('path/name.ext'))
+
+    def test_set(self):
+        TestModule.init(self)
+        modules.Set.allowed = True
+        e = resorter.utils.Expression(r'if(nam=="name",test.set("xyz"),none)', modules.FUNCTIONS)
+        self.assertEqual('xyz', e.calc('path/name.ext'))
+        self.assertFalse(TestModule.called_get)
+        self.assertTrue(TestModule.called_set)
+        modules.Set.allowed = False
+
+    def test_error(self):
+        e = resorter.utils.Expression(r'name.num', modules.FUNCTIONS)
+        with self.assertRaises(resorter.utils.FuncError) as cm:
+            e.calc('path/name.ext')
+        self.assertEqual('num', cm.exception.funcb.name)
+        self.assertEqual(['name.ext'], cm.exception.funcb.args)
+
+
+class TestOptimize(unittest.TestCase):
+    def test_fold(self):
+        expressions = [
+                (r'1024*1024', '1048576'),
+                (r'"/srv/"+"photos"+name', "('/srv/photos' + name)"),
+                (r'-2^3', '-8'),
+                (r'if(name~="a.*", 1)', "if((name ~= re'a.*'), 1)"),
+                (r'ext.in(".jpg",".png")', "ext.in{'.jpg', '.png'}"),
+                (r'has("a")', "has{'a'}"),
+                (r'ext.in(".jpg",name)', "ext.in('.jpg', name)"),
+                (r'1 || name', '1'),
+                (r'0 || name', 'name'),
+                (r'"a" ~= "("', "('a' ~= '(')"),
+                ]
+        for expr, expected in expressions:
+            e = resorter.utils.Expression(expr, modules.FUNCTIONS)
+            self.assertEqual(expected, e.explain(), expr)
+
+    def test_reorder(self):
+        expressions = [
+                (r'not(name=="x") && ext==".jpg"', "((ext == '.jpg') && not((name == 'x')))"),
+                (r'not(name=="x") || ext==".jpg" || nam=="y"', "(((ext == '.jpg') || (nam == 'y')) || not((name == 'x')))"),
+                (r'size>1 && ext==".jpg"', "((size > 1) && (ext == '.jpg'))"), # size may raise: nothing moves past it
+                (r'not(name=="a") && size>1 && not(name=="b") && ext==".x"',
+                 "(((not((name == 'a')) && (size > 1)) && (ext == '.x')) && not((name == 'b')))"),
+                (r'ext.num>1 && ext==".jpg"', "((ext.num > 1) && (ext == '.jpg'))"),
+                (r'ext==".jpg" || nam.has("x")', "((ext == '.jpg') || nam.has{'x'})"), # None if nam is
+                (r'all(not(name=="x"), name~="a.*")', "all((name ~= re'a.*'), not((name == 'x')))"),
+                (r'size || ext', '(size || ext)'),
+                (r'size>1 && counter>1', '((size > 1) && (counter > 1))'),
+                ]
+        for expr, expected in expressions:
+            e = resorter.utils.Expression(expr, modules.FUNCTIONS)
+            self.assertEqual(expected, e.explain(), expr)
+
+    def test_guard(self):
+        e = resorter.utils.Expression(r'nam.up.low ~= "X.*" && ext.num > 1', modules.FUNCTIONS)
+        self.assertIs(False, e.calc('path/name.ext')) # ext.num not computed
+        e = resorter.utils.Expression(r'ext.num>1 && ext==".jpg"', modules.FUNCTIONS)
+        with self.assertRaises(resorter.utils.FuncError): # as from left to right, not False
+            e.calc('path/name.ext')
+
+    def test_custom(self):
+        self.addCleanup(modules.Custom.funcs.pop, 'cmd')
+        for pure in (False, True):
+            modules.append(['cmd=true'], pure)
+            e = resorter.utils.Expression(r'cmd', dict(modules.FUNCTIONS, **modules.Custom.functions()))
+            self.assertIs(pure, all(root.pure() for root in e.tree)) # opted in
+
+    def test_backends(self):
+        e = resorter.utils.Expression(r'if(size>1, name, ext)', modules.FUNCTIONS)
+        self.assertEqual({'FileInfo': 'stat'}, e.backends())
+        e = resorter.utils.Expression(r'name', modules.FUNCTIONS)
+        self.assertEqual({}, e.backends())
+
+    def test_interpreted(self):
+        e = resorter.utils.Expression(r'1+2', modules.FUNCTIONS, compiled=False)
+        self.assertEqual("interpreted [['NUMBER', 1], ['NUMBER', 2], ['OP', '+']]", e.explain())
+
+
+class TestContext(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        def probe(key, args):
+            self.calls.append(args)
+            return args[-1]
+        self.functions = dict(modules.FUNCTIONS)
+        self.functions['probe'] = {'func': probe, 'help': 'probe'}
+
+    def test_memo(self):
+        ctx = resorter.utils.Context('path/name.ext')
+        a = resorter.utils.Expression(r'probe["%Y"]+probe["%m"]', self.functions)
+        b = resorter.utils.Expression(r'probe["%Y"]', self.functions)
+        self.assertEqual('%Y%m', a.calc(ctx))
+        self.assertEqual('%Y', b.calc(ctx))
+        self.assertEqual([['path/name.ext', '%Y'], ['path/name.ext', '%m']], self.calls)
+        b.calc('path/other.ext')
+        self.assertEqual(3, len(self.calls))
+
+    def test_impure(self):
+        ctx = resorter.utils.Context('name')
+        e = resorter.utils.Expression(r'counter[1]', self.functions)
+        modules.Counter.count, modules.Counter.step = None, 1 # whatever the tests before left
+        self.addCleanup(setattr, modules.Counter, 'count', None)
+        self.assertEqual(1, e.calc(ctx))
+        self.assertEqual(2, e.calc(ctx))
+
+    def test_lazy(self):
+        expressions = [
+                (r'if(ext==".jpg", probe, none)', None),
+                (r'if(ext==".ext", none, probe.up)', None),
+                (r'name.if(ext==".jpg", probe)', 'name.ext'),
+                (r'any(ext==".ext", probe)', True),
+                (r'all(ext==".jpg", probe, probe[1])', False),
+                (r'ext==".ext" || probe', True),
+                (r'ext==".jpg" && probe', False),
+                ]
+        for expr, expected in expressions:
+            e = resorter.utils.Expression(expr, self.functions)
+            self.assertEqual(expected, e.calc('path/name.ext'), expr)
+        self.assertEqual([], self.calls)
+        e = resorter.utils.Expression(r'if(ext==".ext", probe["x"], none)', self.functions)
+        self.assertEqual('x', e.calc('path/name.ext'))
+        self.assertEqual([['path/name.ext', 'x']], self.calls)
+
+    def test_lazy_error(self):
+        e = resorter.utils.Expression(r'if(ext==".ext", name.num, none)', self.functions)
+        with self.assertRaises(resorter.utils.FuncError) as cm:
+            e.calc('path/name.ext')
+        self.assertEqual('num', cm.exception.funcb.name)
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as d:
+            names = []
+            for i, ext in enumerate(['.jpg', '.txt', '.jpg', '.png']):
+                names.append(os.path.join(d, f'{i}{ext}'))
+                with open(names[-1], 'wb') as f:
+                    f.write(b'x' * 1000 * i)
+            texts = [r'size>1500 && ext==".jpg"', r'size[k]', r'-size+1', r'mtime["%Y"]>"1970"',
+                     r'ext.in(".png",".txt") || probe', r'if(size>1, name, none)', r'name']
+            rows = [[resorter.utils.Expression(t, self.functions).calc(n) for t in texts] for n in names]
+            self.assertEqual([[names[0]], [names[2]]], self.calls)
+            self.calls.clear()
+
+            expressions = [resorter.utils.Expression(t, self.functions) for t in texts]
+            shared = resorter.utils.share(expressions, roots=True)
+            contexts = [resorter.utils.Context(n) for n in names]
+            batch = list(resorter.batch.batches(contexts, expressions, 3, shared))
+            self.assertEqual(contexts, batch)
+            self.assertIn(r"((size > 1500) && (ext == '.jpg'))", contexts[3].memo)
+            self.assertNotIn('name', contexts[0].memo)
+            self.assertEqual([[names[0]], [names[2]]], self.calls)
+            self.assertEqual(rows, [[e.calc(ctx) for e in expressions] for ctx in contexts])
+
+    def test_share(self):
+        a = resorter.utils.Expression(r'(probe.up+"x").low', self.functions)
+        b = resorter.utils.Expression(r'if(probe.up+"x"=="A", 1, 2)', self.functions)
+        self.assertEqual({"(probe.up + 'x')"}, resorter.utils.shared_keys([a, b]))
+        resorter.utils.share([a, b])
+        ctx = resorter.utils.Context('a')
+        self.assertEqual('ax', a.calc(ctx))
+        self.assertEqual(2, b.calc(ctx))
+        self.assertEqual([['a']], self.calls)
+        self.assertIn("(probe.up + 'x')", ctx.memo)
+
+class TestPushdown(unittest.TestCase):
+    def create(self, *texts):
+        return resorter.pushdown.create([resorter.utils.Expression(t, modules.FUNCTIONS) for t in texts])
+
+    def test_create(self):
+        self.assertIsNone(self.create(r'name'))
+        self.assertIsNone(self.create(r'if(ext==".jpg", name)'))
+        self.assertIsNone(self.create(r'if(ext==".jpg", name, none)', r'name'))
+        self.assertIsNone(self.create(r'if(counter>2)'))
+        self.assertIsNotNone(self.create(r'if(ext==".jpg", name, none)', r'name.if(nam=="a")'))
+
+    def test_accept(self):
+        select = self.create(r'if(ext.low==".jpg" && size>10, name, none)', r'if(nam=="x")')
+        self.assertTrue(select.accept('a/b.JPG'))
+        self.assertTrue(select.accept('a/x.txt'))
+        self.assertFalse(select.accept('a/b.txt'))
+        select = self.create(r'if(any(ext==".png", ext==".jpg") || name.num>1)')
+        self.assertTrue(select.accept('a/b.png'))
+        self.assertTrue(select.accept('a/b.txt'))
+        select = self.create(r'if(all(ext==".png", not(name.has("x"))))')
+        self.assertFalse(select.accept('a/x.png'))
+
+    def test_descend(self):
+        select = self.create(r'if(not(path.has(".git", "cache")) && ext==".jpg")')
+        self.assertTrue(select.descend('a/b'))
+        self.assertFalse(select.descend('a/.git'))
+        self.assertFalse(select.descend('a/.git/objects'))
+        self.assertFalse(select.descend('a/cache'))
+        select = self.create(r'if(path.has("photos") && ext==".jpg")')
+        self.assertTrue(select.descend('a/b'))
+
+    def test_walk(self):
+        with tempfile.TemporaryDirectory() as d:
+            for f in ['a.jpg', 'b.txt', '.git/c.jpg', 'sub/d.jpg', 'sub/e.png']:
+                os.makedirs(os.path.dirname(os.path.join(d, f)), exist_ok=True)
+                open(os.path.join(d, f), 'w').close()
+            select = self.create(r'if(ext==".jpg" && not(path.has(".git")))')
+            found = resorter.utils.read_filenames(d, True, select)
+            self.assertEqual(['a.jpg', 'sub/d.jpg'], sorted(os.path.relpath(f, d) for f in found))
+
+
+class TestWalker(unittest.TestCase):
+    def test_parallel(self):
+        with tempfile.TemporaryDirectory() as d:
+            for i in range(30):
+                path = os.path.join(d, *[str(j) for j in range(i % 5)], f'dir{i}')
+                os.makedirs(path)
+                for j in range(i % 4):
+                    with open(os.path.join(path, f'{j}.txt'), 'wb') as f:
+                        f.write(b'x' * j)
+            serial = sorted(resorter.utils.read_filenames(d, True))
+            self.assertEqual(43, len(serial))
+            for threads in (2, 8):
+                found = list(resorter.utils.read_filenames(d, True, None, threads, True))
+                self.assertEqual(serial, sorted(found))
+                self.assertTrue(all(f.st is not None for f in found))
+                self.assertEqual(sorted(os.path.getsize(f) for f in serial), sorted(f.stat().st_size for f in found))
+            self.assertEqual([], list(resorter.utils.read_filenames(d, False, None, 4)))
+
+    def test_error(self):
+        with self.assertRaises(FileNotFoundError):
+            list(resorter.utils.read_filenames('/nonexistent/dir', True, None, 4))
+
+    def test_prune(self):
+        with tempfile.TemporaryDirectory() as d:
+            for path in ('a.jpg', 'b.txt', '.hidden.jpg', '.git/c.jpg', 'x/d.jpg', 'x/y/e.jpg', 'x/y/z/f.jpg', 'cache/g.jpg'):
+                os.makedirs(os.path.dirname(os.path.join(d, path)), exist_ok=True)
+                open(os.path.join(d, path), 'w').close()
+            found = lambda prune, threads=1: sorted(os.path.relpath(f, d) for f in resorter.utils.read_filenames(d, True, prune, threads))
+            self.assertEqual(['a.jpg', 'x/d.jpg', 'x/y/e.jpg', 'x/y/z/f.jpg'],
+                    found(resorter.utils.Prune(['*.jpg'], ['cache'], skip_hidden=True)))
+            self.assertEqual(['.hidden.jpg', 'a.jpg', 'b.txt', 'x/d.jpg'],
+                    found(resorter.utils.Prune(exclude=['x/y', '.git', 'cache'])))
+            for threads in (1, 4):
+                self.assertEqual(['a.jpg', 'b.txt', 'x/d.jpg'],
+                        found(resorter.utils.Prune(max_depth=1, skip_hidden=True, one_file_system=True,
+                            select=resorter.utils.Prune(exclude=['cache'])), threads))
+            self.assertEqual(['a.jpg'], found(resorter.utils.Prune(['a.*'], max_depth=0)))
+
+    def test_globs(self):
+        with tempfile.TemporaryDirectory() as d:
+            for path in ('IMG/x.txt', 'IMG/IMG_1.txt', 'a[1].jpg', 'b.jpg'):
+                os.makedirs(os.path.dirname(os.path.join(d, path)), exist_ok=True)
+                open(os.path.join(d, path), 'w').close()
+            found = lambda prune: sorted(os.path.relpath(f, d) for f in resorter.utils.read_filenames(d, True, prune))
+            self.assertEqual(['IMG/x.txt', 'a[1].jpg', 'b.jpg'], found(resorter.utils.Prune(exclude=['I*t']))) # not IMG/x.txt
+            self.assertEqual(['IMG/IMG_1.txt', 'IMG/x.txt'], found(resorter.utils.Prune(['I*/*'])))
+            self.assertEqual(['a[1].jpg'], found(resorter.utils.Prune(['?[[]1].*'])))
+            self.assertEqual(['IMG/IMG_1.txt', 'a[1].jpg'], found(resorter.utils.Prune(exclude=['[!IMa]*'])))
+
+    def test_stream(self):
+        data = b'a/b.jpg\r\n\nc d.txt\n\xff.bin\nlast'
+        for size in (1, 3, 1 << 20):
+            self.assertEqual(['a/b.jpg', 'c d.txt', os.fsdecode(b'\xff.bin'), 'last'],
+                    list(resorter.utils.read_lines(io.BytesIO(data), size=size)))
+        self.assertEqual(['new\nline', 'tab\t'], list(resorter.utils.read_lines(io.BytesIO(b'new\nline\0tab\t\0'), b'\0', 4)))
+        self.assertEqual(['x', 'y'], list(resorter.utils.read_filenames(io.TextIOWrapper(io.BytesIO(b'x\ny\n')), False)))
+        with tempfile.TemporaryDirectory() as d:
+            open(os.path.join(d, 'f'), 'w').close()
+            names = (d + '\n').encode()
+            self.assertEqual([d], list(resorter.utils.read_filenames(io.BytesIO(names), False)))
+            self.assertEqual([os.path.join(d, 'f')], list(resorter.utils.read_filenames(io.BytesIO(names), False, directories=True)))
+
+    def test_entry_stat(self):
+        entry = resorter.utils.PathEntry('no/such/file.ext')
+        entry.st = os.stat_result((0, 0, 0, 0, 0, 0, 42, 0, 0, 0))
+        self.assertEqual('file.ext', resorter.utils.Expression(r'name', modules.FUNCTIONS).calc(entry))
+        self.assertEqual(42, resorter.utils.Expression(r'size', modules.FUNCTIONS).calc(entry))
+
+
+class TestMetadataCache(unittest.TestCase):
+    class Data(object):
+        def __init__(self, f):
+            self.f = f
+            self.closed = False
+        def close(self):
+            self.closed = True
+
+    def test_lru(self):
+        cache = modules.MetadataCache(4)
+        with tempfile.TemporaryDirectory() as d:
+            names = [os.path.join(d, f'{i}.jpg') for i in range(3)]
+            for n in names:
+                open(n, 'w').close()
+            a = cache.get('Data', names[0], self.Data)
+            self.assertIs(a, cache.get('Data', names[0], self.Data))
+            self.assertEqual((2, 2), (cache.hits, cache.misses)) # stat and data
+            b = cache.get('Data', names[1], self.Data)
+            self.assertFalse(a.closed)
+            cache.get('Data', names[2], self.Data)
+            self.assertTrue(a.closed)
+            self.assertFalse(b.closed)
+            cache.invalidate(names[1])
+            self.assertTrue(b.closed)
+            self.assertIsNot(b, cache.get('Data', names[1], self.Data))
+            cache.clear()
+            self.assertEqual({}, cache.paths)
+
+    def test_rewritten(self):
+        cache = modules.MetadataCache()
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, 'a.jpg')
+            open(name, 'w').close()
+            a = cache.get('Data', resorter.utils.PathEntry(name), self.Data)
+            os.utime(name, ns=(0, 10 ** 9)) # rewritten
+            self.assertIsNot(a, cache.get('Data', resorter.utils.PathEntry(name), self.Data)) # found again
+
+    def test_disk(self):
+        opened = []
+        def open_(f):
+            opened.append(f)
+            return {'tags': [f]}
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, 'a.jpg')
+            open(name, 'w').close()
+            for _ in range(2): # runs
+                cache = modules.MetadataCache()
+                cache.disk = resorter.diskcache.DiskCache(os.path.join(d, 'cache', 'metadata.db'))
+                self.assertEqual({'tags': [name]}, cache.get('Data', name, open_, True))
+            self.assertEqual([name], opened)
+            with open(name, 'w') as f:
+                f.write('changed')
+            cache.clear()
+            cache.get('Data', name, open_, True)
+            self.assertEqual(2, len(opened))
+
+            disk = resorter.diskcache.DiskCache(os.path.join(d, 'small.db'), limit=1000, check_every=1)
+            for i in range(20):
+                disk.put('Data', os.stat_result((0, i, 1, 0, 0, 0, 0, 0, 0, 0)), b'x' * 100)
+            size = disk.db().execute('SELECT total(length(data)) FROM metadata').fetchone()[0]
+            self.assertLessEqual(size, 1000)
+            self.assertIsNot(resorter.utils.MISSING, disk.get('Data', os.stat_result((0, 19, 1, 0, 0, 0, 0, 0, 0, 0))))
+
+    def test_rename(self):
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, 'a.txt')
+            with open(name, 'w') as f:
+                f.write('abc')
+            self.assertEqual(3, resorter.utils.Expression(r'size', modules.FUNCTIONS).calc(name))
+            modules.Set.allowed = True
+            try:
+                renamed = resorter.utils.Expression(r'ext.set(".log")', modules.FUNCTIONS).calc(name)
+            finally:
+                modules.Set.allowed = False
+            self.assertEqual(os.path.join(d, 'a.log'), renamed)
+            with open(name, 'w') as f:
+                f.write('abcdef')
+            self.assertEqual(6, resorter.utils.Expression(r'size', modules.FUNCTIONS).calc(name))
+
+
+def jpeg_with_exif(path):
+    """JPEG header: Make, DateTime, Flash in the EXIF IFD and a GPS latitude, 640x480"""
+    def entries(items, offset):
+        # items: (tag, type, count, payload bytes); payloads over 4 bytes stored after the IFD
+        head = struct.pack('<H', len(items))
+        extra = b''
+        start = offset + 2 + 12 * len(items) + 4
+        for tag, typ, count, payload in items:
+            if len(payload) > 4:
+                head += struct.pack('<HHII', tag, typ, count, start + len(extra))
+                extra += payload
+            else:
+                head += struct.pack('<HHI', tag, typ, count) + payload.ljust(4, b'\0')
+        return head + struct.pack('<I', 0) + extra
+    date = b'2019:08:03 13:40:00\0'
+    ifd0 = entries([(271, 2, 6, b'Canon\0'), (0x132, 2, len(date), date), (0x8769, 4, 1, struct.pack('<I', 0)),
+                    (0x8825, 4, 1, struct.pack('<I', 0))], 8)
+    exif = entries([(0x9209, 3, 1, struct.pack('<H', 0x19))], 8 + len(ifd0))
+    gps_at = 8 + len(ifd0) + len(exif)
+    gps = entries([(1, 2, 2, b'S\0'), (2, 5, 3, struct.pack('<6I', 48, 1, 30, 1, 36, 1))], gps_at)
+    ifd0 = entries([(271, 2, 6, b'Canon\0'), (0x132, 2, len(date), date), (0x8769, 4, 1, struct.pack('<I', 8 + len(ifd0))),
+                    (0x8825, 4, 1, struct.pack('<I', gps_at))], 8)
+    tiff = b'II*\0' + struct.pack('<I', 8) + ifd0 + exif + gps
+    app1 = b'Exif\0\0' + tiff
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1)
+        f.write(b'\xff\xdb' + struct.pack('>H', 4) + b'\0\0') # a table
+        f.write(b'\xff\xc0' + struct.pack('>HBHH', 11, 8, 480, 640) + b'\0' * 4)
+        f.write(b'\xff\xda' + b'\0' * 64)
+
+class TestExif(unittest.TestCase):
+    def test_header(self):
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, 'a.jpg')
+            jpeg_with_exif(name)
+            data = resorter.exif.read(name, {271, 0x132, 0x9209})
+            self.assertEqual((640, 480), data['size'])
+            self.assertEqual('Canon', data['exif'][271])
+            self.assertEqual({1: 'S', 2: ((48, 1), (30, 1), (36, 1))}, data['exif'][0x8825])
+            expressions = [
+                    (r'exif_make', 'Canon'),
+                    (r'exif_time["%Y"]', '2019'),
+                    (r'exif_flash', 'Yes'),
+                    (r'exif_lat', -48.51),
+                    (r'image_width*image_height', 640 * 480),
+                    ]
+            for text, value in expressions:
+                self.assertEqual(value, resorter.utils.Expression(text, modules.FUNCTIONS).calc(name), text)
+            with open(name, 'wb') as f:
+                f.write(b'not an image')
+            self.assertIsNone(resorter.exif.read(name, {271}))
+
+
+def id3v2(version, frames, audio=b'\xff\xfb' * 64):
+    """MP3 with an ID3v2 tag of (frame id, body) or (frame id, body, flags) frames"""
+    def size(n, safe):
+        return bytes([n >> 21 & 0x7f, n >> 14 & 0x7f, n >> 7 & 0x7f, n & 0x7f]) if safe else struct.pack('>I', n)
+    frames = [(f[0], f[1], f[2] if len(f) > 2 else 0) for f in frames]
+    body = b''.join(fid + size(len(data), version == 4) + struct.pack('>H', flags) + data for fid, data, flags in frames) + b'\0' * 32
+    return b'ID3' + bytes([version, 0, 0]) + size(len(body), True) + body + audio
+
+class TestId3(unittest.TestCase):
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, 'a.mp3')
+            with open(name, 'wb') as f:
+                f.write(id3v2(3, [(b'TIT2', b'\0Title'), (b'APIC', b'\0' * 5000), (b'TPE1', b'\1' + 'Ärtist'.encode('utf-16')),
+                                  (b'TRCK', b'\0003/12'), (b'TCON', b'\0(17)')]))
+            self.assertEqual({'title': 'Title', 'artist': 'Ärtist', 'album': '', 'composer': '', 'genre': 'Rock',
+                              'track': 3, 'disc': 0}, resorter.id3.read(name))
+            self.assertEqual('Ärtist-3', resorter.utils.Expression(r'id3_artist+"-"+id3_track', modules.FUNCTIONS).calc(name))
+
+            with open(name, 'wb') as f:
+                f.write(id3v2(4, [(b'TALB', b'\3' + 'Albüm'.encode()), (b'TPOS', b'\0002')]))
+            tags = resorter.id3.read(name)
+            self.assertEqual(('Albüm', 2), (tags['album'], tags['disc']))
+
+            for version, flag in ((3, 0x0020), (4, 0x0040)): # grouping identity
+                with open(name, 'wb') as f:
+                    f.write(id3v2(version, [(b'TIT2', b'\x07\0Grouped', flag), (b'TPE1', b'\0Artist')]))
+                tags = resorter.id3.read(name)
+                self.assertEqual(('Grouped', 'Artist'), (tags['title'], tags['artist']))
+
+            with open(name, 'wb') as f:
+                f.write(b'\xff\xfb' * 100 + b'TAG' + b'Old'.ljust(30, b'\0') + b'Band'.ljust(30, b'\0') + b'\0' * 30 +
+                        b'1999' + b'\0' * 28 + b'\0\x07' + b'\x08')
+            tags = resorter.id3.read(name)
+            self.assertEqual(('Old', 'Band', 7, 'Jazz'), (tags['title'], tags['artist'], tags['track'], tags['genre']))
+
+            with open(name, 'wb') as f:
+                f.write(b'\xff\xfb' * 100)
+            self.assertIsNone(resorter.id3.read(name))
+
+
+class TestContent(unittest.TestCase):
+    def test_hash(self):
+        with tempfile.TemporaryDirectory() as d:
+            names = [os.path.join(d, n) for n in ('a', 'b', 'c', 'empty')]
+            data = [b'x' * 200000, b'x' * 100000 + b'y' + b'x' * 99999, b'x' * 199999 + b'y', b'']
+            for n, content in zip(names, data):
+                with open(n, 'wb') as f:
+                    f.write(content)
+            calc = lambda text, n: resorter.utils.Expression(text, modules.FUNCTIONS).calc(n)
+            for n, content in zip(names, data):
+                self.assertEqual(hashlib.sha256(content).hexdigest(), calc(r'hash', n))
+                self.assertEqual(hashlib.md5(content).hexdigest(), calc(r'hash["md5"]', n))
+            self.assertEqual(hashlib.blake2b(data[0]).hexdigest(), calc(r'hash["blake2b"]', names[0]))
+            self.assertEqual(calc(r'headhash[1000]', names[0]), calc(r'headhash[1000]', names[1]))
+            self.assertNotEqual(calc(r'headhash[1000]', names[0]), calc(r'headhash[1000]', names[2]))
+            hits = modules.Module.CACHE.hits
+            calc(r'hash["md5"]', names[0])
+            self.assertEqual(hits + 2, modules.Module.CACHE.hits) # stat and digest
+            with self.assertRaises(resorter.utils.FuncError):
+                calc(r'hash["nope"]', names[0])
+
+
+class TestDupes(unittest.TestCase):
+    def test_dupes(self):
+        with tempfile.TemporaryDirectory() as d:
+            big = os.urandom(300000)
+            files = {'a.jpg': big, 'b.jpg': big, 'c.png': big, 'd.jpg': big[:-1] + b'!', 'e.jpg': b'small', 'f.png': b'small',
+                     'g.jpg': b'other', 'empty1': b'', 'empty2': b''}
+            for n, content in files.items():
+                with open(os.path.join(d, n), 'wb') as f:
+                    f.write(content)
+            def groups(text):
+                e = resorter.utils.Expression(text, modules.FUNCTIONS)
+                action = resorter.actions.dupes.Dupes([e])
+                out = io.StringIO()
+                printed = []
+                with contextlib.redirect_stdout(out):
+                    for n in sorted(files):
+                        action.act(os.path.join(d, n), [e.calc(os.path.join(d, n))])
+                        printed.append(out.getvalue().count('\n\n')) # as soon as found
+                    action.finalize()
+                found = [[os.path.basename(p) for p in g.split('\n')] for g in out.getvalue().strip().split('\n\n')]
+                return found, printed
+            found, printed = groups(r'""')
+            self.assertEqual([['a.jpg', 'b.jpg'], ['a.jpg', 'c.png'], ['e.jpg', 'f.png']], found)
+            self.assertEqual([0, 1, 2, 2, 2, 2, 2, 3, 3], printed)
+            self.assertEqual([['a.jpg', 'b.jpg']], groups(r'ext')[0])
+
+
+class TestSimilar(unittest.TestCase):
+    def test_hashes(self):
+        image = [100 + 60 * math.sin(x / 5) * math.cos(y / 7) + x for y in range(32) for x in range(32)]
+        brighter = [p * 1.1 + 5 for p in image]
+        transposed = [image[x * 32 + y] for y in range(32) for x in range(32)]
+        phash = resorter.modules.image.phash
+        self.assertEqual(phash(image), phash(brighter))
+        self.assertNotEqual(phash(image), phash(transposed))
+        self.assertEqual('0000000000000000', resorter.modules.image.dhash(list(range(72))))
+        self.assertEqual('ffffffffffffffff', resorter.modules.image.dhash(list(range(72, 0, -1))))
+
+    def test_bktree(self):
+        rnd = random.Random(1)
+        values = [rnd.getrandbits(16) for _ in range(500)]
+        tree = resorter.actions.similar.BKTree()
+        for i, v in enumerate(values):
+            tree.add(v, i)
+        for v in values[:20]:
+            found = sorted(i for _, _, items in tree.search(v, 3) for i in items)
+            self.assertEqual([i for i, w in enumerate(values) if resorter.actions.similar.distance(v, w) <= 3], found)
+
+    def test_groups(self):
+        action = resorter.actions.similar.Similar([])
+        hashes = {'a': 'ff00ff00ff00ff00', 'b': 'ff00ff00ff00ff01', 'c': 'ff00ff00ff00ff03', 'd': '00ff00ff00ff00ff', 'e': None}
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            for n, h in hashes.items():
+                action.act(n, [h, 1])
+            action.finalize()
+        self.assertEqual('a\nb\nc\n\n', out.getvalue())
+
+
+class TestMedia(unittest.TestCase):
+    def test_request(self):
+        functions = dict(modules.FUNCTIONS, track={'func': Media.track})
+        e = lambda text: resorter.utils.Expression(text, functions)
+        Media.request([e(r'track["Video","format"]+track["duration"]'), e(r'name')])
+        self.assertEqual({'format', 'duration'}, Media.properties)
+        Media.request([e(r'track["Video",name]')])
+        self.assertIsNone(Media.properties)
+
+    def test_cache_key(self):
+        parsed = []
+        class Fake(Media):
+            @classmethod
+            def open(cls, f):
+                parsed.append((cls.parse_speed, cls.read_limit))
+                return {}
+        self.addCleanup(setattr, modules.Module, 'CACHE', modules.Module.CACHE)
+        modules.Module.CACHE = modules.MetadataCache()
+        with tempfile.NamedTemporaryFile() as f:
+            for speed, limit in ((0.5, None), (1, None), (1, 1024), (1, 1024)):
+                Fake.parse_speed, Fake.read_limit = speed, limit
+                Fake.cache(f.name)
+        self.assertEqual([(0.5, None), (1, None), (1, 1024)], parsed)
+
+    def test_limited(self):
+        f = resorter.modules.media.Limited(io.BytesIO(b'0123456789'), 4)
+        self.assertEqual(b'012', f.read(3))
+        f.seek(8)
+        self.assertEqual(b'8', f.read())
+        self.assertEqual(b'', f.read(2))
+
+
+class TestIndex(unittest.TestCase):
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as d:
+            names = [os.path.join(d, n) for n in ('a.txt', 'b.txt')]
+            for n in names:
+                open(n, 'w').close()
+            db = os.path.join(d, 'index.db')
+            expressions = [resorter.utils.Expression(r'name.up', modules.FUNCTIONS)]
+            index = resorter.index.Index(db, expressions)
+            self.assertIs(resorter.utils.MISSING, index.lookup(names[0]))
+            index.store(names[0], ['A.TXT'])
+            index.close()
+
+            index = resorter.index.Index(db, expressions)
+            self.assertEqual(['A.TXT'], index.lookup(names[0]))
+            changed = list(index.changed(resorter.utils.Context(n) for n in names))
+            self.assertEqual([names[1]], [c.source for c in changed])
+            self.assertEqual([names[1]], list(index.states)) # kept to store the changed file only
+            with open(names[0], 'w') as f:
+                f.write('changed')
+            self.assertIs(resorter.utils.MISSING, index.lookup(names[0]))
+            self.assertIs(resorter.utils.MISSING, index.lookup(os.path.join(d, 'missing')))
+            index.close()
+
+            index = resorter.index.Index(db, [resorter.utils.Expression(r'name', modules.FUNCTIONS)])
+            self.assertIs(resorter.utils.MISSING, index.lookup(names[0]))
+            index.close()
+
+    def test_impure(self):
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, 'a.txt')
+            open(name, 'w').close()
+            db = os.path.join(d, 'index.db')
+            expressions = [resorter.utils.Expression(r'name+counter', modules.FUNCTIONS)]
+            index = resorter.index.Index(db, expressions)
+            index.store(name, ['a.txt1'])
+            index.close()
+            index = resorter.index.Index(db, expressions)
+            self.assertIs(resorter.utils.MISSING, index.lookup(name)) # computed again
+            self.assertEqual([], list(index.changed([resorter.utils.Context(name)]))) # yet unchanged
+            index.close()
+
+    def test_pipeline(self):
+        with tempfile.TemporaryDirectory() as d:
+            names = [os.path.join(d, f'{i}.txt') for i in range(50)]
+            for n in names:
+                open(n, 'w').close()
+            db = os.path.join(d, 'index.db')
+            expressions = [resorter.utils.Expression(r'name.up', modules.FUNCTIONS)]
+            for stored in (0, 50):
+                index = resorter.index.Index(db, expressions)
+                def compute(n):
+                    v = index.lookup(n)
+                    return n, [os.path.basename(n).upper()] if v is resorter.utils.MISSING else v
+                stages = [resorter.pipeline.Stage('evaluate', compute, 4),
+                          resorter.pipeline.Stage('act', lambda item: index.store(*item), 2)]
+                resorter.pipeline.Pipeline(names, stages, 4).run()
+                self.assertEqual((stored, 50 - stored), (index.hits, index.misses))
+                index.close()
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify')
+class TestWatch(unittest.TestCase):
+    def test_watch(self):
+        with tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, 'sub'))
+            open(os.path.join(d, 'old.jpg'), 'w').close()
+            watcher = resorter.watch.Watcher(d, True, resorter.utils.Prune(exclude=['*.tmp']), 0.2)
+            batches = watcher.batches()
+            self.assertEqual([os.path.join(d, 'old.jpg')], next(batches))
+            for name in ('a.jpg', 'b.tmp', 'sub/c.jpg', 'new/d.jpg'):
+                os.makedirs(os.path.dirname(os.path.join(d, name)), exist_ok=True)
+                with open(os.path.join(d, name), 'w') as f:
+                    f.write(name)
+            os.rename(os.path.join(d, 'b.tmp'), os.path.join(d, 'b.jpg'))
+            self.assertEqual(sorted(os.path.join(d, n) for n in ('a.jpg', 'b.jpg', 'sub/c.jpg', 'new/d.jpg')), sorted(next(batches)))
+            batches.close()
+
+    def test_stop(self):
+        with tempfile.TemporaryDirectory() as d:
+            watcher = resorter.watch.Watcher(d, False)
+            batches = watcher.batches()
+            self.assertEqual([], next(batches))
+            with ThreadPoolExecutor(1) as pool:
+                waiting = pool.submit(next, batches, None) # no event comes
+                time.sleep(0.1)
+                watcher.stop()
+                self.assertIsNone(waiting.result(5))
+            watcher.stop() # once closed
+
+    def test_pipeline(self):
+        resort = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'resort')
+        with tempfile.TemporaryDirectory() as d:
+            for name in ('a.txt', 'b.txt'):
+                open(os.path.join(d, name), 'w').close()
+            run = subprocess.run([sys.executable, resort, '-f', d, '--watch', '0.2', '--pipeline', '--limit', '1', 'print', 'name'],
+                                 stdout=subprocess.PIPE, timeout=30) # stops once a file is printed
+            self.assertEqual(0, run.returncode)
+            self.assertEqual(1, len(run.stdout.splitlines()))
+
+
+class TestParallel(unittest.TestCase):
+    def test_evaluate(self):
+        def compute(i):
+            time.sleep(random.random() / 1000)
+            if i % 7 == 3:
+                raise ValueError(i)
+            return i * i
+        for jobs in (1, 4):
+            results = list(resorter.parallel.evaluate(range(100), compute, jobs, chunk=3))
+            self.assertEqual(list(range(100)), [i for i, _, _ in results])
+            self.assertEqual([i * i for i in range(100) if i % 7 != 3], [v for _, v, e in results if e is None])
+            self.assertEqual([i for i in range(100) if i % 7 == 3], [e.args[0] for _, _, e in results if e is not None])
+        unordered = resorter.parallel.evaluate(range(100), compute, 4, chunk=3, ordered=False)
+        self.assertEqual(list(range(100)), sorted(i for i, _, _ in unordered))
+
+    def test_stop(self):
+        computed = []
+        def compute(i):
+            computed.append(i)
+            return i
+        results = resorter.parallel.evaluate(itertools.count(), compute, 2, chunk=4)
+        self.assertEqual((0, 0, None), next(results))
+        results.close()
+        self.assertLessEqual(len(computed), 16) # two chunks per thread in flight
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run(self):
+        acted = []
+        def slow(i):
+            time.sleep(random.random() / 500)
+            return resorter.pipeline.SKIP if i % 10 == 0 else i * 2
+        stages = [resorter.pipeline.Stage('double', slow, 4), resorter.pipeline.Stage('act', acted.append)]
+        resorter.pipeline.Pipeline(range(200), stages, 8).run()
+        self.assertEqual([i * 2 for i in range(200) if i % 10], acted)
+        self.assertEqual(200, stages[0].count)
+        self.assertEqual(180, stages[1].count)
+
+    def test_stop(self):
+        read = []
+        def items():
+            for i in itertools.count():
+                read.append(i)
+                yield i
+        acted = []
+        def act(i):
+            acted.append(i)
+            return resorter.pipeline.STOP if i == 5 else None
+        stages = [resorter.pipeline.Stage('same', lambda i: i, 2), resorter.pipeline.Stage('act', act)]
+        resorter.pipeline.Pipeline(items(), stages, 4).run()
+        self.assertEqual(list(range(6)), acted)
+        self.assertLess(len(read), 30) # bounded by the queues
+
+    def test_error(self):
+        def items():
+            yield from range(10)
+            raise PermissionError('scan')
+        acted = []
+        stages = [resorter.pipeline.Stage('same', lambda i: i, 2), resorter.pipeline.Stage('act', acted.append)]
+        with self.assertRaises(PermissionError):
+            resorter.pipeline.Pipeline(items(), stages, 4).run()
+        self.assertEqual(list(range(10)), acted)
+
+    def test_unordered(self):
+        def slow(i):
+            time.sleep(0.2 if i == 0 else 0)
+            return i
+        for ordered in (True, False):
+            acted = []
+            stages = [resorter.pipeline.Stage('slow', slow, 4), resorter.pipeline.Stage('act', acted.append)]
+            resorter.pipeline.Pipeline(range(8), stages, 8, ordered).run()
+            self.assertEqual(list(range(8)), sorted(acted))
+            self.assertEqual(ordered, acted[0] == 0)
+
+
+class TestSort(unittest.TestCase):
+    def test_encode(self):
+        import datetime
+        values = ['b', None, 2.5, datetime.date(2020, 1, 1), 'a', 1, [1, 'x'], float('nan'), True, b'a']
+        ordered = sorted(range(len(values)), key=lambda i: resorter.sort.encode(values[i]))
+        self.assertEqual([1, 5, 8, 2, 7, 4, 0, 9, 3, 6], ordered) # True == 1
+
+    def test_spill(self):
+        paths = [f'/d/{random.randrange(100):02}_{i:04}' for i in range(1000)]
+        key = lambda c: (resorter.sort.encode(c.source[3:5]),)
+        contexts = [resorter.utils.Context(p) for p in paths]
+        for reverse in (False, True):
+            expected = sorted(paths, key=lambda p: p[3:5], reverse=reverse) # stable
+            for memory in (1 << 30, 4096):
+                result = list(resorter.sort.sort(contexts, key, reverse, memory))
+                self.assertEqual(expected, [c.source for c in result])
+                self.assertTrue(all(isinstance(c, resorter.utils.Context) for c in result))
+
+    def test_keys(self):
+        names = ['b.txt', 'a.jpg', 'c.jpg', 'a.txt', 'noext']
+        key = resorter.sort.keys([resorter.utils.Expression(e, modules.FUNCTIONS) for e in ('ext', 'name')])
+        result = resorter.sort.sort((resorter.utils.Context(n) for n in names), key, memory=1)
+        self.assertEqual(['noext', 'a.jpg', 'c.jpg', 'a.txt', 'b.txt'], [c.source for c in result])
+
+    def test_top(self):
+        contexts = [resorter.utils.Context(f'{random.randrange(50):02}_{i:04}') for i in range(500)]
+        key = lambda c: (resorter.sort.encode(c.source[:2]),)
+        for reverse in (False, True):
+            expected = [c.source for c in resorter.sort.sort(contexts, key, reverse)][:20]
+            self.assertEqual(expected, [c.source for c in resorter.sort.top(contexts, key, 20, reverse)])
+        self.assertEqual([], resorter.sort.top(contexts, key, 0))
+
+
+class TestThreads(unittest.TestCase):
+    def test_stress(self):
+        texts = [
+                r'if(size>100 && ext==".jpg", nam.up+"_"+size[k].round[2], (path.split,name).join)',
+                r'any(size<50, name.has("7")) || name~=".*9.*"',
+                ]
+        with tempfile.TemporaryDirectory() as d:
+            names = []
+            for i in range(200):
+                names.append(os.path.join(d, f'{i}.{"jpg" if i % 3 else "txt"}'))
+                with open(names[-1], 'wb') as f:
+                    f.write(b'x' * i)
+            for compiled in (True, False):
+                expressions = [resorter.utils.Expression(t, modules.FUNCTIONS, compiled) for t in texts]
+                calc = lambda n: [e.calc(resorter.utils.Context(n)) for e in expressions]
+                serial = [calc(n) for n in names]
+                interval = sys.getswitchinterval()
+                sys.setswitchinterval(1e-6) # switch threads as often as possible
+                try:
+                    with ThreadPoolExecutor(max_workers=16) as pool:
+                        for _ in range(5):
+                            self.assertEqual(serial, list(pool.map(calc, names)))
+                finally:
+                    sys.setswitchinterval(interval)
+
 
 if __name__=='__main__':
     loglevel = logging.DEBUG